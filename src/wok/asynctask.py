@@ -20,57 +20,644 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
 import cherrypy
+import errno
+import multiprocessing
+import os
+import pickle
 import threading
+import time
 import traceback
 
 
-from wok.exception import OperationFailed
+from cherrypy.process.plugins import BackgroundTask
+from multiprocessing.queues import SimpleQueue
+
+from wok.config import config as configParser
+from wok.exception import InvalidOperation, InvalidParameter
+from wok.exception import OperationFailed, TaskCancelled
+
+
+# States of the tasks which are not done yet
+ACTIVE_STATES = ['queued', 'running']
+
+# Interval in seconds between two checks of the deadlines of running tasks
+DEADLINE_CHECK_INTERVAL = 1
+
+# Task priorities: queued tasks of a higher priority run first. Use
+# 'interactive' for operations a user is waiting for and 'bulk' for
+# background jobs.
+PRIORITIES = {'bulk': 0, 'normal': 1, 'interactive': 2}
+
+# Where task functions run: in a worker thread of the executor, or in a
+# process of the process pool, see AsyncTask
+MODES = ['thread', 'process']
+
+# Fields of the task records
+TASK_FIELDS = ['id', 'target_uri', 'message', 'status']
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Tasks of this process which are not done yet, by id, and the thread
+# saving their progress
+_tasks = {}
+_tasks_lock = threading.Lock()
+_progress_saver = None
+
+# Pool of processes running the tasks in 'process' mode, the queue their
+# status messages are sent through, and the tasks they run, by id
+_process_pool = None
+_process_queue = None
+_process_tasks = {}
+_process_lock = threading.Lock()
+
+# Interval in seconds between two checks that the pool process running a
+# task is still alive
+PROCESS_CHECK_INTERVAL = 0.5
+
+
+def _parse_limits(value):
+    # "kimchi:4, ginger:2" -> {'kimchi': 4, 'ginger': 2}
+    limits = {}
+    for item in value.split(','):
+        if item.strip():
+            plugin, count = item.rsplit(':', 1)
+            limits[plugin.strip()] = int(count)
+    return limits
+
+
+def task_plugin(target_uri):
+    """Return the name of the plugin owning <target_uri>, 'wok' for the
+    URIs of Wok itself."""
+    parts = (target_uri or '').split('/')
+    if len(parts) > 2 and parts[1] == 'plugins' and parts[2]:
+        return parts[2]
+    return 'wok'
+
+
+def _current_user():
+    # Name of the user logged in the current request, see wok.auth.USER_NAME
+    try:
+        return cherrypy.session.get('username')
+    except AttributeError:
+        return None
+
+
+def get_task(id):
+    """Return the AsyncTask <id> if it is queued or running in this process,
+    None otherwise."""
+    with _tasks_lock:
+        return _tasks.get(str(id))
+
+
+def _register(task):
+    global _progress_saver
+    with _tasks_lock:
+        _tasks[task.id] = task
+        if _progress_saver is None and task.progress_interval > 0:
+            _progress_saver = BackgroundTask(task.progress_interval,
+                                             _save_progress)
+            _progress_saver.start()
+
+
+def _unregister(task):
+    with _tasks_lock:
+        if _tasks.get(task.id) is task:
+            del _tasks[task.id]
+
+
+def _save_progress():
+    # Saves the progress reported by the tasks since they were last saved
+    with _tasks_lock:
+        tasks = _tasks.values()
+    for task in tasks:
+        try:
+            task._save_progress()
+        except Exception:
+            cherrypy.log.error_log.error("Unable to save progress of task %s"
+                                         % task.id)
+            cherrypy.log.error_log.error(traceback.format_exc())
+
+
+def get_executor():
+    """Return the executor running the async tasks of this process, set up
+    from the tasks section of the config on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            plugins = configParser.get('tasks', 'plugin_workers')
+            _executor = TaskExecutor(configParser.getint('tasks', 'workers'),
+                                     configParser.getint('tasks',
+                                                         'queue_size'),
+                                     _parse_limits(plugins))
+        return _executor
+
+
+def get_process_pool():
+    """Return the pool of processes running the async tasks in 'process'
+    mode, started with as many processes as set in the tasks section of the
+    config on first use."""
+    global _process_pool, _process_queue
+    with _process_lock:
+        if _process_pool is None:
+            processes = configParser.getint('tasks', 'processes') or None
+            # Messages are written right away, not by a feeder thread which
+            # a dying process would take its last messages with
+            _process_queue = SimpleQueue()
+            _process_pool = multiprocessing.Pool(processes, _process_init,
+                                                 (_process_queue,))
+            relay = threading.Thread(target=_relay_status,
+                                     args=(_process_queue,))
+            relay.setDaemon(True)
+            relay.start()
+        return _process_pool
+
+
+def _process_init(queue):
+    # Runs in the pool processes
+    global _process_queue
+    _process_queue = queue
+
+
+def _process_run(id, fn, opaque, timeout):
+    # Runs the task <id> in a pool process. The parent is sent
+    # (id, 'start', pid) first, then (id, 'status', (message, success)) for
+    # each status message and (id, 'exit', None) once <fn> returns.
+    _process_queue.put((id, 'start', os.getpid()))
+    cb = _ProcessCallback(id, timeout)
+    try:
+        fn(cb, opaque)
+    except TaskCancelled, e:
+        cb(e.message, False)
+    except Exception, e:
+        cherrypy.log.error_log.error("Error in async_task %s " % id)
+        cherrypy.log.error_log.error(traceback.format_exc())
+        cb("Unexpected exception: %s" % e.message, False)
+    finally:
+        _process_queue.put((id, 'exit', None))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _relay_status(queue):
+    # Applies the messages sent by the pool processes to the tasks
+    while True:
+        id, event, value = queue.get()
+        with _process_lock:
+            task = _process_tasks.get(id)
+            if event == 'exit':
+                _process_tasks.pop(id, None)
+        if task is None:
+            continue
+
+        try:
+            if event == 'start':
+                task._pid = value
+            elif event == 'exit':
+                task._exited.set()
+            else:
+                task._status_cb(*value)
+        except Exception:
+            cherrypy.log.error_log.error("Unable to update task %s" % id)
+            cherrypy.log.error_log.error(traceback.format_exc())
+
+
+class CancelToken(object):
+    """Cancellation state of a task.
+
+    Task functions find it as cb.token. Long running ones should call
+    check() between steps, which raises TaskCancelled once the task is
+    cancelled or past its deadline, and sleep with wait() so they wake up
+    on cancellation. The deadline is <timeout> seconds after the task
+    starts running, None meaning no deadline.
+    """
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.deadline = None
+        self._event = threading.Event()
+
+    def start(self):
+        if self.timeout is not None:
+            self.deadline = time.time() + self.timeout
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def remaining(self):
+        """Return the number of seconds left until the deadline, None if
+        there is none."""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def wait(self, timeout=None):
+        """Sleep up to <timeout> seconds or until the task is cancelled or
+        past its deadline, and return whether it is."""
+        remaining = self.remaining()
+        if remaining is not None and (timeout is None or remaining < timeout):
+            timeout = remaining
+        self._event.wait(timeout)
+        return self.cancelled or self.expired
+
+    def check(self, id=None):
+        if self.expired:
+            raise TaskCancelled("WOKASYNC0008E",
+                                {'id': id, 'seconds': self.timeout})
+        if self.cancelled:
+            raise TaskCancelled("WOKASYNC0007E", {'id': id})
+
+
+class _StatusCallback(object):
+    # The cb passed to the task functions: reports the status of <task>
+    # when called, and gives them its cancellation token
+    def __init__(self, task):
+        self.task = task
+        self.token = task.token
+
+    def __call__(self, message, success=None):
+        self.task._status_cb(message, success)
+
+    def check(self):
+        self.token.check(self.task.id)
+
+
+class _ProcessCallback(object):
+    # The cb passed to the task functions run in a pool process: sends the
+    # status of the task to the parent process. Its token only knows about
+    # the deadline of the task, not about cancel().
+    def __init__(self, id, timeout):
+        self.id = id
+        self.token = CancelToken(timeout)
+        self.token.start()
+
+    def __call__(self, message, success=None):
+        _process_queue.put((self.id, 'status', (message, success)))
+
+    def check(self):
+        self.token.check(self.id)
+
+
+class TaskExecutor(object):
+    """Runs async tasks on a bounded pool of worker threads.
+
+    Submitted tasks are queued and run by at most <workers> threads, which
+    are started as needed and then kept for the next tasks. <plugin_limits>
+    maps plugin names to the maximum number of their tasks running at once:
+    the tasks of a plugin at its limit stay queued while the ones of other
+    plugins run. submit() raises OperationFailed once <queue_size> tasks are
+    queued, 0 meaning no limit.
+
+    Free workers pick the queued task of the highest priority. Among tasks
+    of the same priority they share the workers fairly: they pick a task
+    of the user with the fewest running tasks, then of the plugin with the
+    fewest running tasks, then the oldest one. So a user or plugin queueing
+    many tasks only gets the workers nobody else needs. Tasks of a lower
+    priority wait for as long as higher priority ones are queued.
+
+    Cancelled tasks leave the queue, or give their worker slot back right
+    away if they are running: another worker thread takes over, and the
+    one running the task ends once the task function returns. Running
+    tasks past their deadline are cancelled.
+    """
+    def __init__(self, workers, queue_size=0, plugin_limits=None):
+        self.workers = max(workers, 1)
+        self.queue_size = queue_size
+        self.plugin_limits = plugin_limits or {}
+        self._cond = threading.Condition()
+        self._queue = []
+        # Number of running tasks of each plugin and of each user
+        self._running = {}
+        self._running_users = {}
+        self._threads = []
+        self._idle = 0
+        # Running tasks, mapped to their worker thread
+        self._active = {}
+        self._deadline_checker = None
+
+    def submit(self, task):
+        with self._cond:
+            if self.queue_size and len(self._queue) >= self.queue_size:
+                raise OperationFailed("WOKASYNC0004E",
+                                      {'size': self.queue_size})
+            self._queue.append(task)
+            if task.token.timeout is not None and \
+                    self._deadline_checker is None:
+                self._deadline_checker = BackgroundTask(
+                    DEADLINE_CHECK_INTERVAL, self._check_deadlines)
+                self._deadline_checker.start()
+            self._wake_worker()
+
+    def _wake_worker(self):
+        # Called with the lock held, when there are queued tasks
+        if (len(self._queue) > self._idle and
+                len(self._threads) < self.workers):
+            thread = threading.Thread(target=self._worker)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+        else:
+            self._cond.notify()
+
+    def cancel(self, task):
+        """Remove <task> from the queue, or free the worker slot it runs
+        in."""
+        with self._cond:
+            if task in self._queue:
+                self._queue.remove(task)
+                return
+
+            thread = self._active.pop(task, None)
+            if thread is None:
+                return
+            self._threads.remove(thread)
+            self._count(task, -1)
+            if self._queue:
+                self._wake_worker()
+
+    def _check_deadlines(self):
+        with self._cond:
+            expired = [t for t in self._active if t.token.expired]
+        for task in expired:
+            try:
+                task._expire()
+            except Exception:
+                # Keep checking the deadlines of the other tasks
+                cherrypy.log.error_log.error(traceback.format_exc())
+
+    def _next(self):
+        # Task to run next among the ones of plugins below their limit, if
+        # any, see the class docstring
+        best = None
+        for i, task in enumerate(self._queue):
+            running = self._running.get(task.plugin, 0)
+            limit = self.plugin_limits.get(task.plugin)
+            if limit is not None and running >= limit:
+                continue
+            key = (-task.priority, self._running_users.get(task.user, 0),
+                   running, i)
+            if best is None or key < best:
+                best = key
+        return None if best is None else self._queue.pop(best[-1])
+
+    def _count(self, task, n):
+        self._running[task.plugin] = self._running.get(task.plugin, 0) + n
+        self._running_users[task.user] = \
+            self._running_users.get(task.user, 0) + n
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                task = self._next()
+                while task is None:
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                    task = self._next()
+                self._count(task, 1)
+                self._active[task] = threading.current_thread()
+
+            try:
+                task._run()
+            finally:
+                with self._cond:
+                    if self._active.pop(task, None) is None:
+                        # Cancelled: another thread took this one's place
+                        return
+                    self._count(task, -1)
+
+    def stats(self):
+        """Return the number of worker threads ('workers'), of queued tasks
+        ('queued') and of running tasks of each plugin ('running')."""
+        with self._cond:
+            return {'workers': len(self._threads), 'queued': len(self._queue),
+                    'running': dict((p, n) for p, n in
+                                    self._running.iteritems() if n)}
 
 
 class AsyncTask(object):
-    def __init__(self, id, target_uri, fn, objstore, opaque=None):
+    """Task running <fn>(cb, opaque) in the background.
+
+    Tasks are 'queued' until a worker of <executor>, the one of this
+    process by default, runs them, in the order given by their <priority>
+    (see PRIORITIES) and by TaskExecutor. They are then 'running' until <fn>
+    reports success or failure through cb(message, success), which makes
+    them 'finished' or 'failed'.
+
+    cancel() makes the task 'cancelled' and frees its worker slot. So does
+    running for more than <timeout> seconds. <fn> is not interrupted: it
+    should check cb.token (see CancelToken) to stop early. Whatever it
+    reports after the task is cancelled is ignored.
+
+    In 'process' <mode>, <fn> runs in a process of the process pool (see
+    get_process_pool()) rather than in the worker thread, which waits for
+    it, so that CPU-bound tasks do not hold the GIL of the server. <fn> and
+    <opaque> must be picklable: <fn> is a module level function. Status
+    messages are sent back to this process and applied to the task. The
+    token of cb only sees the deadline of the task.
+
+    Progress reported by cb(message) is kept in memory, and saved at most
+    once every progress_interval milliseconds (an option of the tasks
+    config section) by the calling thread or by a background thread saving
+    the last progress of all tasks. States are saved right away. Until it
+    is done, the current state of a task is returned by info(), and the
+    task by get_task(). Its <done> event is set once it is done.
+    """
+    def __init__(self, id, target_uri, fn, objstore, opaque=None,
+                 executor=None, priority='normal', timeout=None,
+                 mode='thread'):
         if objstore is None:
             raise OperationFailed("WOKASYNC0001E")
+        if priority not in PRIORITIES:
+            raise InvalidParameter("WOKASYNC0005E",
+                                   {'priority': priority,
+                                    'priorities': ', '.join(sorted(
+                                        PRIORITIES, key=PRIORITIES.get))})
+        if mode not in MODES:
+            raise InvalidParameter("WOKASYNC0011E",
+                                   {'mode': mode, 'modes': ', '.join(MODES)})
+        if mode == 'process':
+            try:
+                pickle.dumps((fn, opaque))
+            except Exception, e:
+                raise InvalidParameter("WOKASYNC0012E", {'err': str(e)})
 
         self.id = str(id)
         self.target_uri = target_uri
+        self.plugin = task_plugin(target_uri)
+        self.user = _current_user()
+        self.priority = PRIORITIES[priority]
         self.fn = fn
+        self.opaque = opaque
         self.objstore = objstore
-        self.status = 'running'
+        self.executor = executor or get_executor()
+        self.token = CancelToken(timeout)
+        self.mode = mode
+        self.status = 'queued'
         self.message = 'OK'
+        self.progress_interval = configParser.getint(
+            'tasks', 'progress_interval') / 1000.0
+        self._lock = threading.RLock()
+        # Set once the task is done, and notified on every change
+        self.done = threading.Event()
+        self._changed = threading.Condition(self._lock)
+        # Whether the message changed since the last save, and its time
+        self._dirty = False
+        self._saved = 0
         self._save_helper()
+        _register(self)
         self._cp_request = cherrypy.serving.request
-        self.thread = threading.Thread(target=self._run_helper,
-                                       args=(opaque, self._status_cb))
-        self.thread.setDaemon(True)
-        self.thread.start()
+        try:
+            self.executor.submit(self)
+        except OperationFailed, e:
+            self._status_cb(e.message, False)
+            raise
+
+    def info(self):
+        """Return the current record of the task."""
+        with self._lock:
+            return dict((attr, getattr(self, attr)) for attr in TASK_FIELDS)
+
+    def wait_change(self, info, timeout):
+        """Wait up to <timeout> seconds until the record of the task differs
+        from <info>, and return it."""
+        deadline = time.time() + timeout
+        with self._lock:
+            while self.info() == info:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            return self.info()
+
+    def cancel(self):
+        """Cancel the task, unless it is already done."""
+        if not self._cancel(TaskCancelled("WOKASYNC0007E", {'id': self.id})):
+            raise InvalidOperation("WOKASYNC0009E", {'id': self.id})
+
+    def _expire(self):
+        self._cancel(TaskCancelled("WOKASYNC0008E",
+                                   {'id': self.id,
+                                    'seconds': self.token.timeout}))
+
+    def _cancel(self, e):
+        if not self._finish('cancelled', e.message):
+            return False
+        self.token.cancel()
+        self.executor.cancel(self)
+        return True
 
     def _status_cb(self, message, success=None):
-        if success is None:
+        if success is not None:
+            self._finish('finished' if success else 'failed', message)
+            return
+
+        with self._lock:
+            if self.status not in ACTIVE_STATES:
+                return
             self.message = message
+            self._changed.notify_all()
+            self._dirty = True
+            if time.time() - self._saved >= self.progress_interval:
+                self._save_helper()
+
+    def _finish(self, status, message):
+        # Records the final state of the task, returns False if it was
+        # already done
+        with self._lock:
+            if self.status not in ACTIVE_STATES:
+                return False
+            self.status = status
+            self.message = message
+            self._changed.notify_all()
             self._save_helper()
-            return
 
-        if success is not None:
-            self.status = 'finished' if success else 'failed'
-        self.message = message
-        self._save_helper()
+        # Make sure the final status is on disk in group commit mode
+        self.objstore.flush()
+        _unregister(self)
+        self.done.set()
+        return True
+
+    def _save_progress(self):
+        with self._lock:
+            if self._dirty:
+                self._save_helper()
 
     def _save_helper(self):
-        obj = {}
-        for attr in ('id', 'target_uri', 'message', 'status'):
-            obj[attr] = getattr(self, attr)
-        try:
-            with self.objstore as session:
-                session.store('task', self.id, obj)
-        except Exception as e:
-            raise OperationFailed('WOKASYNC0002E', {'err': e.message})
+        with self._lock:
+            obj = self.info()
+            try:
+                with self.objstore as session:
+                    session.store('task', self.id, obj)
+            except Exception as e:
+                raise OperationFailed('WOKASYNC0002E', {'err': e.message})
+            self._dirty = False
+            self._saved = time.time()
 
-    def _run_helper(self, opaque, cb):
+    def _run(self):
+        # Called by a worker of the executor
         cherrypy.serving.request = self._cp_request
         try:
-            self.fn(cb, opaque)
+            with self._lock:
+                if self.status != 'queued':
+                    # Cancelled while it was picked up
+                    return
+                self.status = 'running'
+                self.token.start()
+                self._changed.notify_all()
+                self._save_helper()
+            if self.mode == 'process':
+                self._run_process()
+            else:
+                self.fn(_StatusCallback(self), self.opaque)
+        except TaskCancelled, e:
+            self._finish('cancelled', e.message)
         except Exception, e:
             cherrypy.log.error_log.error("Error in async_task %s " % self.id)
             cherrypy.log.error_log.error(traceback.format_exc())
-            cb("Unexpected exception: %s" % e.message, False)
+            self._status_cb("Unexpected exception: %s" % e.message, False)
+
+    def _run_process(self):
+        # Waits for the pool process running the task to be done with it,
+        # that is for its last status message to be applied. The task fails
+        # if the job fails in the pool or the process dies before. Once the
+        # task is done, e.g. cancelled, the process is not waited for.
+        self._exited = threading.Event()
+        self._pid = None
+        with _process_lock:
+            _process_tasks[self.id] = self
+        try:
+            result = get_process_pool().apply_async(
+                _process_run, (self.id, self.fn, self.opaque,
+                               self.token.timeout))
+            while not self._exited.wait(PROCESS_CHECK_INTERVAL):
+                if self.status not in ACTIVE_STATES:
+                    return
+                if result.ready() and not result.successful():
+                    try:
+                        result.get()
+                    except Exception, e:
+                        self._status_cb("Unexpected exception: %s" %
+                                        e.message, False)
+                    return
+                if self._pid is not None and not _alive(self._pid):
+                    e = OperationFailed("WOKASYNC0014E",
+                                        {'id': self.id, 'pid': self._pid})
+                    self._status_cb(e.message, False)
+                    return
+        finally:
+            with _process_lock:
+                _process_tasks.pop(self.id, None)
@@ -33,7 +33,7 @@ from wok.exception import InvalidOperation, InvalidParameter
 from wok.exception import MissingParameter, NotFoundError
 from wok.exception import OperationFailed, UnauthorizedError, WokException
 from wok.reqlogger import RequestRecord
-from wok.utils import get_plugin_from_request, utf8_dict
+from wok.utils import get_plugin_from_request, search_match, utf8_dict
 
 
 # Default request log messages
@@ -308,6 +308,11 @@ class Collection(object):
       needs additional information to identify this Collection.
 
     - Implement the base operations of 'create' and 'get_list' in the model.
+
+    - Optionally implement 'search' in the model. It gets the '_search' query
+      parameter after the model arguments and returns the matching idents,
+      like 'get_list'. Without it, the resources returned by 'get_list' are
+      matched against the query.
     """
     def __init__(self, model):
         self.model = model
@@ -337,9 +342,17 @@ class Collection(object):
         return res.get()
 
     def _get_resources(self, flag_filter):
+        query = flag_filter.pop('_search', None)
         try:
-            get_list = getattr(self.model, model_fn(self, 'get_list'))
-            idents = get_list(*self.model_args, **flag_filter)
+            if query is not None and hasattr(self.model,
+                                             model_fn(self, 'search')):
+                search = getattr(self.model, model_fn(self, 'search'))
+                idents = search(*(list(self.model_args) + [query]),
+                                **flag_filter)
+                query = None
+            else:
+                get_list = getattr(self.model, model_fn(self, 'get_list'))
+                idents = get_list(*self.model_args, **flag_filter)
             res_list = []
             for ident in idents:
                 # internal text, get_list changes ident to unicode for sorted
@@ -347,6 +360,9 @@ class Collection(object):
                 res = self.resource(self.model, *args)
                 res.lookup()
                 res_list.append(res)
+            if query is not None:
+                res_list = [r for r in res_list
+                            if search_match(r.data, query)]
             return res_list
         except AttributeError:
             return []
@@ -19,8 +19,108 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
+import cherrypy
+import json
+import time
+
+import wok.template
+from wok.asynctask import ACTIVE_STATES
+from wok.auth import USER_NAME, USER_ROLES
 from wok.control.base import Collection, Resource
-from wok.control.utils import UrlSubNode
+from wok.control.utils import get_class_name, model_fn, UrlSubNode
+from wok.control.utils import validate_method
+from wok.exception import InvalidParameter, NotFoundError, OperationFailed
+from wok.exception import UnauthorizedError
+from wok.model.tasks import release_slot, wait_slot, WaitingStream
+
+
+# Maximum time in seconds a GET /tasks/<id>?wait=<seconds> request waits
+# for the task to change
+MAX_WAIT = 60
+
+# Time in seconds an event stream lasts, unless the client asks for less:
+# clients then open a new one, so that each stream only holds a server
+# thread for so long
+EVENTS_TIMEOUT = 300
+
+# Interval in seconds between two comments sent on an event stream without
+# events, so that it is not closed by proxies
+EVENTS_KEEPALIVE = 15
+
+
+def _seconds(value, maximum):
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = -1
+    if not seconds >= 0:
+        raise InvalidParameter("WOKASYNC0006E", {'value': value})
+    return min(seconds, maximum)
+
+
+# Characters making a filter a regular expression rather than a plain
+# prefix, see Collection.filter_data()
+REGEX_CHARS = set('.^$*+?{}[]\\|()')
+
+# Task states, for which status filters are exact matches
+TASK_STATES = set(ACTIVE_STATES + ['finished', 'failed', 'cancelled'])
+
+
+def _plain(value):
+    return isinstance(value, basestring) and not REGEX_CHARS & set(value)
+
+
+def _count(param, value):
+    if value is None:
+        return None
+    try:
+        count = int(value)
+    except ValueError:
+        count = -1
+    if count < 0:
+        raise InvalidParameter("WOKASYNC0013E", {'param': param,
+                                                 'value': value})
+    return count
+
+
+def _session_user():
+    # User whose tasks the caller may see and cancel, None for all of them
+    roles = cherrypy.session.get(USER_ROLES, {})
+    if 'admin' in roles.values():
+        return None
+    return cherrypy.session.get(USER_NAME)
+
+
+def _wait_slot():
+    # Takes a slot for a request waiting for tasks, see wait_slot(), and
+    # answers 503 if there is none left. The caller releases it.
+    try:
+        wait_slot()
+    except OperationFailed, e:
+        raise cherrypy.HTTPError(503, e.message)
+
+
+def _event(task):
+    # None stands for a keep-alive comment
+    if task is None:
+        return ':\n\n'
+    return 'event: task\ndata: %s\n\n' % json.dumps(task)
+
+
+def _event_stream(tasks):
+    # Server-Sent Events stream of the task records in <tasks>. Headers are
+    # sent before the body is streamed, so they are set here.
+    stream = _events(tasks)
+    cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+    cherrypy.response.headers['Cache-Control'] = 'no-cache'
+    return stream
+
+
+def _events(tasks):
+    # The slot is released once the stream ends, or is closed as the client
+    # went away or was never sent anything
+    _wait_slot()
+    return WaitingStream(_event(task) for task in tasks)
 
 
 @UrlSubNode("tasks", True)
@@ -29,6 +129,47 @@ class Tasks(Collection):
         super(Tasks, self).__init__(model)
         self.resource = Task
 
+    def get(self, filter_params):
+        # Task records are read along with the list, in one query, rather
+        # than looked up one by one as by Collection.get(). That is only
+        # for filters which match the same tasks either way: a task state,
+        # and a target_uri prefix. Other filters, such as lists of values
+        # or regular expressions, are checked on each task.
+        params = dict(filter_params)
+        limit = _count('_limit', params.pop('_limit', None))
+        offset = _count('_offset', params.pop('_offset', None))
+        status = params.get('status')
+        if (set(params) <= set(['status', 'target_uri']) and
+                (status is None or _plain(status) and
+                 status in TASK_STATES) and
+                _plain(params.get('target_uri', ''))):
+            query = getattr(self.model, model_fn(self, 'query'))
+            tasks = query(params.get('status'), params.get('target_uri'),
+                          limit, offset)
+        else:
+            flag_filter = dict((key, params.pop(key)) for key in
+                               params.keys() if key.startswith('_'))
+            resources = self._get_resources(flag_filter)
+            start = offset or 0
+            end = None if limit is None else start + limit
+            tasks = self.filter_data(resources, params)[start:end]
+        return wok.template.render(get_class_name(self), tasks)
+
+    @cherrypy.expose
+    def events(self, timeout=None):
+        """Stream the changes of the tasks of the logged user, or of all
+        tasks for administrators, as Server-Sent Events."""
+        validate_method(('GET',), self.role_key, self.admin_methods)
+        try:
+            timeout = _seconds(timeout or EVENTS_TIMEOUT, EVENTS_TIMEOUT)
+        except InvalidParameter, e:
+            raise cherrypy.HTTPError(400, e.message)
+
+        watch = getattr(self.model, model_fn(self, 'watch'))
+        return _event_stream(watch(_session_user(), timeout,
+                                   EVENTS_KEEPALIVE))
+    events._cp_config = {'response.stream': True}
+
 
 class Task(Resource):
     def __init__(self, model, id):
@@ -37,3 +178,57 @@ class Task(Resource):
     @property
     def data(self):
         return self.info
+
+    def get(self, wait=None):
+        # Long polling: answer once the task changes, or after <wait>
+        # seconds
+        if wait is not None:
+            wait_change = getattr(self.model, model_fn(self, 'wait_change'))
+            seconds = _seconds(wait, MAX_WAIT)
+            _wait_slot()
+            try:
+                self.info = wait_change(*(list(self.model_args) +
+                                          [self.info, seconds]))
+            finally:
+                release_slot()
+        return super(Task, self).get()
+
+    def delete(self):
+        # Users other than administrators only cancel their own tasks
+        delete = getattr(self.model, model_fn(self, 'delete'))
+        delete(*(list(self.model_args) + [_session_user()]))
+        cherrypy.response.status = 204
+
+    @cherrypy.expose
+    def events(self, timeout=None):
+        """Stream the changes of the task as Server-Sent Events, until it is
+        done."""
+        validate_method(('GET',), self.role_key, self.admin_methods)
+        try:
+            timeout = _seconds(timeout or EVENTS_TIMEOUT, EVENTS_TIMEOUT)
+            self.lookup()
+            if not self.is_authorized():
+                raise UnauthorizedError('WOKAPI0009E')
+        except InvalidParameter, e:
+            raise cherrypy.HTTPError(400, e.message)
+        except UnauthorizedError, e:
+            raise cherrypy.HTTPError(403, e.message)
+        except NotFoundError, e:
+            raise cherrypy.HTTPError(404, e.message)
+
+        return _event_stream(self._changes(timeout))
+    events._cp_config = {'response.stream': True}
+
+    def _changes(self, timeout):
+        wait_change = getattr(self.model, model_fn(self, 'wait_change'))
+        deadline = time.time() + timeout
+        task = self.info
+        yield task
+        while task['status'] in ACTIVE_STATES:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            info = wait_change(*(list(self.model_args) +
+                                 [task, min(EVENTS_KEEPALIVE, remaining)]))
+            yield info if info != task else None
+            task = info
@@ -89,6 +89,10 @@ class InvalidOperation(WokException):
     pass
 
 
+class ConflictError(InvalidOperation):
+    pass
+
+
 class IsoFormatError(WokException):
     pass
 
@@ -101,5 +105,9 @@ class TimeoutExpired(WokException):
     pass
 
 
+class TaskCancelled(WokException):
+    pass
+
+
 class UnauthorizedError(WokException):
     pass
@@ -36,6 +36,18 @@ messages = {
     "WOKASYNC0001E": _("Datastore is not initiated in the model object."),
     "WOKASYNC0002E": _("Unable to start task due error: %(err)s"),
     "WOKASYNC0003E": _("Timeout of %(seconds)s seconds expired while running task '%(task)s."),
+    "WOKASYNC0004E": _("Unable to queue task: %(size)s tasks are already waiting to run"),
+    "WOKASYNC0005E": _("Invalid task priority '%(priority)s'. Supported priorities: %(priorities)s"),
+    "WOKASYNC0006E": _("Invalid time '%(value)s'. It must be a positive number of seconds"),
+    "WOKASYNC0007E": _("Task %(id)s was cancelled"),
+    "WOKASYNC0008E": _("Task %(id)s was cancelled after running for more than %(seconds)s seconds"),
+    "WOKASYNC0009E": _("Task %(id)s is already done and cannot be cancelled"),
+    "WOKASYNC0010E": _("Task %(id)s is run by another process and cannot be cancelled by this one"),
+    "WOKASYNC0011E": _("Invalid task mode '%(mode)s'. Supported modes: %(modes)s"),
+    "WOKASYNC0012E": _("Unable to run task in a separate process: %(err)s"),
+    "WOKASYNC0013E": _("Invalid %(param)s '%(value)s'. It must be a positive integer or 0"),
+    "WOKASYNC0014E": _("Process %(pid)s running task %(id)s exited unexpectedly"),
+    "WOKASYNC0015E": _("Too many requests are waiting for tasks to change. Try again later"),
 
     "WOKAUTH0001E": _("Authentication failed for user '%(username)s'. [Error code: %(code)s]"),
     "WOKAUTH0002E": _("You are not authorized to access Kimchi"),
@@ -46,6 +58,15 @@ messages = {
     "WOKLOG0002E": _("Creation of log file failed: %(err)s"),
 
     "WOKOBJST0001E": _("Unable to find %(item)s in datastore"),
+    "WOKOBJST0002E": _("Unable to write %(item)s using a read-only datastore session"),
+    "WOKOBJST0003E": _("Invalid datastore concurrency mode '%(mode)s'. Supported modes: %(modes)s"),
+    "WOKOBJST0004E": _("All %(size)s datastore connections are in use. Gave up waiting after %(seconds)s seconds"),
+    "WOKOBJST0005E": _("Invalid datastore codec '%(codec)s'. Supported codecs: %(codecs)s"),
+    "WOKOBJST0006E": _("Timed out after %(seconds)s seconds waiting for datastore objects to be committed"),
+    "WOKOBJST0007E": _("Datastore pages can only be fetched after an ident in ident order, without a sort key or offset"),
+    "WOKOBJST0008E": _("Invalid datastore engine '%(engine)s'. Supported engines: %(engines)s"),
+    "WOKOBJST0009E": _("%(item)s was changed by another writer: expected revision %(expected)s, found %(found)s"),
+    "WOKOBJST0010E": _("Datastore %(location)s is corrupted: invalid record at offset %(offset)s"),
 
     "WOKUTILS0001E": _("Unable to reach %(url)s. Make sure it is accessible and try again."),
     "WOKUTILS0002E": _("Timeout while running command '%(cmd)s' after %(seconds)s seconds"),
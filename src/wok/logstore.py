@@ -0,0 +1,283 @@
+#
+# Project Wok
+#
+# Copyright IBM Corp, 2016
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import bisect
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+from wok import config
+from wok.exception import InvalidParameter, NotFoundError, OperationFailed
+from wok.objectstore import BaseSession, BaseStore, _unicode
+from wok.utils import wok_log
+
+
+# The log is compacted once it holds more than this many bytes of replaced
+# or deleted records, and more of them than of live records
+COMPACT_MIN_GARBAGE = 1024 * 1024
+
+
+class LogStoreSession(BaseSession):
+    def __init__(self, store, readonly=False):
+        super(LogStoreSession, self).__init__(readonly)
+        self.log = store
+
+    def _entry(self, obj_type, ident):
+        try:
+            return self.log._index[_unicode(obj_type)][_unicode(ident)]
+        except KeyError:
+            raise NotFoundError("WOKOBJST0001E", {'item': ident})
+
+    def get_list(self, obj_type, sort_key=None, limit=None, offset=None,
+                 after=None):
+        if after is not None and (sort_key is not None or
+                                  offset is not None):
+            raise InvalidParameter("WOKOBJST0007E")
+
+        idents = sorted(self.log._index.get(_unicode(obj_type), {}))
+        if after is not None:
+            idents = idents[bisect.bisect_right(idents, _unicode(after)):]
+        if sort_key is not None:
+            objects = self.get_many(obj_type, idents)
+            # Stable sort: objects with equal keys stay in ident order
+            idents.sort(key=lambda ident: objects[ident].get(sort_key))
+        start = offset or 0
+        end = None if limit is None else start + limit
+        return idents[start:end]
+
+    def get(self, obj_type, ident):
+        return self.get_with_rev(obj_type, ident)[0]
+
+    def get_with_rev(self, obj_type, ident):
+        offset, length, _, rev = self._entry(obj_type, ident)
+        return json.loads(self.log._read(offset, length))[4], rev
+
+    def get_object_version(self, obj_type, ident):
+        try:
+            return [self._entry(obj_type, ident)[2]]
+        except NotFoundError:
+            return []
+
+    def get_types(self):
+        return sorted(self.log._index)
+
+    def store(self, obj_type, ident, data, version=None, expected_rev=None):
+        self._check_writable(ident)
+
+        # Get Wok version if none was provided
+        if version is None:
+            version = config.get_version().split('-')[0]
+
+        try:
+            rev = self._entry(obj_type, ident)[3]
+        except NotFoundError:
+            rev = 0
+        if expected_rev is not None and expected_rev != rev:
+            self._conflict(ident, expected_rev, rev)
+
+        self.log._append(['s', obj_type, ident, version, data, rev + 1])
+        self.changes.append((obj_type, ident, 'store'))
+
+    def delete(self, obj_type, ident, ignore_missing=False):
+        self._check_writable(ident)
+        try:
+            self._entry(obj_type, ident)
+        except NotFoundError:
+            if ignore_missing:
+                return
+            raise
+
+        self.log._append(['d', obj_type, ident])
+        self.changes.append((obj_type, ident, 'delete'))
+
+
+class LogStore(BaseStore):
+    """Object store kept in an append-only log file.
+
+    Every store or delete appends one JSON record to the log, so writes
+    never rewrite existing data. An in-memory index maps each object to the
+    position of its last record, which is read back on get(). Once replaced
+    and deleted records take up most of the file, live records are copied
+    to a new log which replaces the old one.
+
+    The log is kept next to <location>, in <location>.log. Sessions are
+    serialized. If <sync> is set, the log is synced to disk when a session
+    that wrote to it is closed.
+    """
+    def __init__(self, location=None, sync=True):
+        super(LogStore, self).__init__()
+        self.location = (location or config.get_object_store()) + '.log'
+        self.sync = sync
+        self._lock = threading.Semaphore()
+        # {obj_type: {ident: (offset, length, version, rev)}}
+        self._index = {}
+        self._size = 0
+        self._live = 0
+        self._fd = None
+        with self._lock:
+            self._load()
+
+            # Because the tasks are regarded as temporary resource, the task
+            # states are purged every time the daemon startup
+            for entry in self._index.pop(u'task', {}).values():
+                self._live -= entry[1]
+            self._compact_if_needed()
+
+    def _open(self):
+        self._fd = os.open(self.location, os.O_RDWR | os.O_CREAT | os.O_APPEND,
+                           0600)
+
+    def _load(self):
+        self._open()
+        offset = 0
+        with open(self.location, 'rb') as f:
+            for line in f:
+                # Only the last record may be partial, if a write was
+                # interrupted by a crash. It is dropped even if it parses:
+                # the next record would be appended to the same line
+                if not line.endswith('\n'):
+                    wok_log.warning("Logstore %s: dropping truncated record "
+                                    "at offset %d" % (self.location, offset))
+                    os.ftruncate(self._fd, offset)
+                    break
+                try:
+                    self._apply(json.loads(line), offset, len(line))
+                except (ValueError, IndexError, TypeError):
+                    os.close(self._fd)
+                    raise OperationFailed("WOKOBJST0010E",
+                                          {'location': self.location,
+                                           'offset': offset})
+                offset += len(line)
+        self._size = offset
+
+    def _apply(self, record, offset, length):
+        objects = self._index.setdefault(record[1], {})
+        old = objects.pop(record[2], None)
+        if old is not None:
+            self._live -= old[1]
+        if record[0] == 's':
+            # Records written before revisions were added have none
+            rev = record[5] if len(record) > 5 else 1
+            objects[record[2]] = (offset, length, record[3], rev)
+            self._live += length
+        elif not objects:
+            del self._index[record[1]]
+
+    def _append(self, record):
+        record[1:3] = _unicode(record[1]), _unicode(record[2])
+        line = json.dumps(record) + '\n'
+        os.write(self._fd, line)
+        self._apply(record, self._size, len(line))
+        self._size += len(line)
+
+    def _read(self, offset, length):
+        os.lseek(self._fd, offset, os.SEEK_SET)
+        return os.read(self._fd, length)
+
+    def _compact_if_needed(self):
+        garbage = self._size - self._live
+        if garbage > COMPACT_MIN_GARBAGE and garbage > self._live:
+            self._compact()
+
+    def _compact(self):
+        start = time.time()
+        path = self.location + '.compact'
+        index = {}
+        offset = 0
+        with open(path, 'wb') as f:
+            for obj_type, objects in self._index.iteritems():
+                entries = index[obj_type] = {}
+                for ident, entry in objects.iteritems():
+                    old, length = entry[:2]
+                    f.write(self._read(old, length))
+                    entries[ident] = (offset,) + entry[1:]
+                    offset += length
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(path, self.location)
+        os.close(self._fd)
+        self._open()
+        wok_log.info("Logstore %s: compacted from %d to %d bytes in %.3fs" %
+                     (self.location, self._size, offset, time.time() - start))
+        self._index = index
+        self._size = self._live = offset
+
+    def backup(self, path):
+        """Copy the log to <path>.log, where LogStore(<path>) reads it, while
+        the store is in use.
+
+        The store lock is only held to get the current end of the log:
+        records before it never change, even if the log is compacted during
+        the copy. The copy is written next to <path> and renamed once
+        complete.
+        """
+        with self._lock:
+            fd = os.open(self.location, os.O_RDONLY)
+            size = self._size
+
+        path += '.log'
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                while size > 0:
+                    data = os.read(fd, min(size, 1024 * 1024))
+                    if not data:
+                        break
+                    f.write(data)
+                    size -= len(data)
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            os.close(fd)
+        os.rename(tmp, path)
+
+    def compact(self):
+        """Rewrite the log with live records only."""
+        with self._lock:
+            self._compact()
+
+    def stats(self):
+        """Return the size in bytes of the log ('size'), of its replaced or
+        deleted records ('free'), and the number of objects of each type
+        ('objects').
+        """
+        with self._lock:
+            return {'size': self._size, 'free': self._size - self._live,
+                    'objects': dict((obj_type, len(objects)) for obj_type,
+                                    objects in self._index.iteritems())}
+
+    @contextmanager
+    def _session(self, readonly=False):
+        session = LogStoreSession(self, readonly)
+        try:
+            with self._lock:
+                try:
+                    yield session
+                finally:
+                    if session.changes:
+                        if self.sync:
+                            os.fsync(self._fd)
+                        self._compact_if_needed()
+        finally:
+            # Notify subscribers outside the lock: they may open sessions
+            self._notify(session.changes)
@@ -23,14 +23,14 @@ import inspect
 import os
 
 from wok.basemodel import BaseModel
-from wok.objectstore import ObjectStore
+from wok.objectstore import open_objectstore
 from wok.utils import import_module, listPathModules
 
 
 class Model(BaseModel):
     def __init__(self, objstore_loc=None):
 
-        self.objstore = ObjectStore(objstore_loc)
+        self.objstore = open_objectstore(objstore_loc)
         kargs = {'objstore': self.objstore}
 
         this = os.path.basename(__file__)
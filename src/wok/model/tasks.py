@@ -20,27 +20,218 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
 
+import Queue
+import threading
 import time
 
-from wok.exception import TimeoutExpired
+from wok.asynctask import ACTIVE_STATES, get_task
+from wok.config import config
+from wok.exception import InvalidOperation, NotFoundError, OperationFailed
+from wok.exception import TimeoutExpired, UnauthorizedError
+
+
+# Interval in seconds between two reads of a task run by another process
+# while waiting for it: doubled after each read, up to the maximum
+WAIT_POLL_INTERVAL = 0.05
+WAIT_POLL_MAX_INTERVAL = 1
+
+# Requests waiting for tasks to change, event streams and long polls, each
+# hold a server thread: at most max_waiting_requests of them (an option of
+# the tasks config section) run at once, so that they leave threads for the
+# other requests
+_waiting = None
+_waiting_lock = threading.Lock()
+
+
+def wait_slot():
+    """Take a slot for a request waiting for tasks to change, or raise
+    OperationFailed if there is none left. Release it with release_slot().
+    """
+    global _waiting
+    with _waiting_lock:
+        if _waiting is None:
+            _waiting = threading.BoundedSemaphore(
+                config.getint('tasks', 'max_waiting_requests'))
+    if not _waiting.acquire(False):
+        raise OperationFailed("WOKASYNC0015E")
+
+
+def release_slot():
+    _waiting.release()
+
+
+class WaitingStream(object):
+    """Iterator over <items>, holding a slot taken with wait_slot().
+
+    The slot is released once the items are exhausted, or close() is
+    called, even if the iteration never started: servers close the
+    responses they stream, whether they sent them or not.
+    """
+    def __init__(self, items):
+        self._items = iter(items)
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return next(self._items)
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        try:
+            close = getattr(self._items, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            release_slot()
+
+
+def _lookup(objstore, id):
+    # Tasks of this process have their current progress in memory
+    task = get_task(id)
+    if task is not None:
+        return task.info()
+    with objstore.reader() as session:
+        return session.get('task', str(id))
 
 
 class TasksModel(object):
     def __init__(self, **kargs):
         self.objstore = kargs['objstore']
+        self.objstore.add_index('task', 'status', 'target_uri')
+        self.objstore.add_search('task', 'target_uri', 'message', 'status')
+        # Tasks in progress do not expire
+        self.objstore.keep('task',
+                           lambda task: task.get('status') in ACTIVE_STATES)
 
     def get_list(self):
-        with self.objstore as session:
+        with self.objstore.reader() as session:
             return session.get_list('task')
 
+    def search(self, query):
+        """Return the idents of the tasks matching the search <query>, as
+        GET /tasks?_search=<query> lists them: see Collection.
+        """
+        with self.objstore.reader() as session:
+            return session.search('task', query)
+
+    def query(self, status=None, target_uri=None, limit=None, offset=None):
+        """Return the records of the tasks with <status> and whose
+        target_uri starts with <target_uri>, newest first. <limit> and
+        <offset> select a page of them.
+
+        Records are read with one object store query, rather than looked
+        up one by one.
+        """
+        criteria = {} if status is None else {'status': status}
+        prefixes = {} if target_uri is None else {'target_uri': target_uri}
+        with self.objstore.reader() as session:
+            tasks = session.query('task', prefixes, limit, offset, True,
+                                  **criteria)
+
+        # Tasks of this process have their current progress in memory
+        records = []
+        for ident, obj in tasks:
+            task = get_task(ident)
+            records.append(obj if task is None else task.info())
+        return records
+
+    def watch(self, user=None, timeout=60, keepalive=15):
+        """Yield the record of every task of <user>, or of any user if None,
+        each time it is saved by this process, for <timeout> seconds.
+
+        None is yielded after <keepalive> seconds without changes, so that
+        callers streaming the records can keep their connections alive.
+        Progress messages are seen as often as they are saved, see
+        AsyncTask.
+        """
+        changed = Queue.Queue()
+
+        def notify(obj_type, ident, event):
+            # Called by the task thread, while the task is still known
+            task = get_task(ident)
+            if user is None or (task is not None and task.user == user):
+                changed.put(ident)
+
+        token = self.objstore.subscribe('task', notify)
+        try:
+            deadline = time.time() + timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                try:
+                    idents = [changed.get(timeout=min(keepalive, remaining))]
+                except Queue.Empty:
+                    yield None
+                    continue
+
+                while not changed.empty():
+                    idents.append(changed.get())
+                for ident in sorted(set(idents), key=idents.index):
+                    try:
+                        yield _lookup(self.objstore, ident)
+                    except NotFoundError:
+                        # Purged meanwhile
+                        continue
+        finally:
+            self.objstore.unsubscribe(token)
+
 
 class TaskModel(object):
     def __init__(self, **kargs):
         self.objstore = kargs['objstore']
 
     def lookup(self, id):
-        with self.objstore as session:
-            return session.get('task', str(id))
+        return _lookup(self.objstore, id)
+
+    def delete(self, id, user=None):
+        """Cancel the task <id>, see AsyncTask.cancel(). Only tasks of
+        <user> are cancelled, unless it is None."""
+        task = get_task(id)
+        if task is not None:
+            if user is not None and task.user != user:
+                raise UnauthorizedError("WOKAPI0009E")
+            task.cancel()
+            return
+
+        if self.lookup(id)['status'] not in ACTIVE_STATES:
+            raise InvalidOperation("WOKASYNC0009E", {'id': id})
+        raise InvalidOperation("WOKASYNC0010E", {'id': id})
+
+    def wait_change(self, id, info, timeout):
+        """Wait up to <timeout> seconds until the record of the task differs
+        from <info>, the one returned by lookup(), and return the current
+        record. It is returned right away if the task is done.
+
+        Like wait(), tasks of this process wake their waiters up as soon as
+        they change, and tasks of other processes are read from the object
+        store.
+        """
+        deadline = time.time() + timeout
+        interval = WAIT_POLL_INTERVAL
+        while True:
+            task = self.lookup(id)
+            remaining = deadline - time.time()
+            if (task != info or task['status'] not in ACTIVE_STATES or
+                    remaining <= 0):
+                return task
+
+            running = get_task(id)
+            if running is not None:
+                running.wait_change(task, remaining)
+            else:
+                time.sleep(min(interval, remaining))
+                interval = min(interval * 2, WAIT_POLL_MAX_INTERVAL)
 
     def wait(self, id, timeout=10):
         """Wait for a task until it stops running (successfully or due to
@@ -52,15 +243,27 @@ class TaskModel(object):
         timeout -- The maximum time, in seconds, that this function should wait
             for the Task. If the Task runs for more than <timeout>,
             "TimeoutExpired" is raised.
-        """
-        for i in range(0, timeout):
-            with self.objstore as session:
-                task = session.get('task', str(id))
 
-            if task['status'] != 'running':
+        Tasks of this process wake their waiters up as soon as they are done.
+        Tasks of other processes are read from the object store, more and
+        more seldom up to once a second.
+        """
+        deadline = time.time() + timeout
+        interval = WAIT_POLL_INTERVAL
+        while True:
+            task = self.lookup(id)
+            if task['status'] not in ACTIVE_STATES:
                 return
 
-            time.sleep(1)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            running = get_task(id)
+            if running is not None:
+                running.done.wait(remaining)
+            else:
+                time.sleep(min(interval, remaining))
+                interval = min(interval * 2, WAIT_POLL_MAX_INTERVAL)
 
         raise TimeoutExpired('WOKASYNC0003E', {'seconds': timeout,
                                                'task': task['target_uri']})
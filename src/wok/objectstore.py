@@ -18,9 +18,14 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
+import cherrypy
 import json
+import marshal
+import os
+import re
 import sqlite3
 import threading
+import time
 import traceback
 
 try:
@@ -28,119 +33,2167 @@ try:
 except ImportError:
     from ordereddict import OrderedDict
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from cherrypy.process.plugins import BackgroundTask
+from contextlib import contextmanager
 
 from wok import config
-from wok.exception import NotFoundError
+from wok.config import config as configParser
+from wok.exception import ConflictError, InvalidParameter, NotFoundError
+from wok.exception import OperationFailed
+from wok.utils import import_class, search_match, search_terms, search_text
 from wok.utils import wok_log
 
 
-class ObjectStoreSession(object):
-    def __init__(self, conn):
+# Concurrency modes:
+#   exclusive: every session (read or write) is serialized by a single lock
+#   wal: the database runs in WAL journal mode, read-only sessions run in
+#        parallel without locking and only writer sessions are serialized
+CONCURRENCY_MODES = ['exclusive', 'wal']
+
+# Pooled connections idle for longer than this (in seconds) are checked
+# before being reused
+HEALTH_CHECK_IDLE_TIME = 60
+
+# Objects re-encoded per writer session when changing codecs, and pause
+# in seconds between those sessions
+CODEC_MIGRATION_BATCH_SIZE = 200
+CODEC_MIGRATION_PAUSE = 0.05
+
+# Storage engines, see open_objectstore()
+ENGINES = {'sqlite': 'wok.objectstore.ObjectStore',
+           'log': 'wok.logstore.LogStore'}
+
+# Maximum time in seconds to wait for queued objects to be committed in
+# group commit mode
+FLUSH_TIMEOUT = 30
+
+# Number of locks serializing writes to the same objects when the cache is
+# enabled, see ObjectCache.locking()
+CACHE_LOCK_STRIPES = 64
+
+# Rows copied per statement by ObjectStore.backup()
+BACKUP_BATCH_SIZE = 1000
+
+# Maximum number of idents bound to a single query, kept below SQLite's
+# default limit of 999 host parameters
+QUERY_BATCH_SIZE = 500
+
+
+def _has_json1():
+    try:
+        sqlite3.connect(':memory:').execute("SELECT json_extract('{}', '$')")
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+# Whether SQLite can query inside the stored JSON documents
+HAS_JSON1 = _has_json1()
+
+
+# Full-text search modules, best first, with the definition of the
+# object_fts table using them
+FTS_MODULES = [('fts5', 'fts5(content)'),
+               ('fts4', 'fts4(content, tokenize=unicode61)')]
+
+
+def _fts_module():
+    conn = sqlite3.connect(':memory:')
+    try:
+        for module, table in FTS_MODULES:
+            try:
+                conn.execute('CREATE VIRTUAL TABLE fts USING %s' % table)
+            except sqlite3.OperationalError:
+                continue
+            return module
+    finally:
+        conn.close()
+    return None
+
+
+# Full-text search module used by search(), None if SQLite has none
+FTS = _fts_module()
+
+
+def _msgpack_loads_args():
+    # msgpack < 0.5.2 has no 'raw' argument to get text back as unicode
+    try:
+        msgpack.unpackb(msgpack.packb(u''), raw=False)
+    except TypeError:
+        return {'encoding': 'utf-8'}
+    return {'raw': False}
+
+
+def _json_key(key):
+    # Dict keys as JSON reads them back
+    if isinstance(key, str):
+        return key.decode('utf-8')
+    return json.loads(json.dumps({key: None})).keys()[0]
+
+
+def _jsonable(obj):
+    # Returns <obj> as JSON would read it back: unicode strings, lists
+    # instead of tuples, string dict keys. Containers are rebuilt as they
+    # are walked, which is cheaper than checking them first.
+    kind = type(obj)
+    if kind is dict:
+        new = {}
+        for key, value in obj.iteritems():
+            if type(key) is not unicode:
+                key = _json_key(key)
+            kind = type(value)
+            if kind is str:
+                value = value.decode('utf-8')
+            elif kind is dict or kind is list or kind is tuple:
+                value = _jsonable(value)
+            new[key] = value
+        return new
+    if kind is list or kind is tuple:
+        new = []
+        for value in obj:
+            kind = type(value)
+            if kind is str:
+                value = value.decode('utf-8')
+            elif kind is dict or kind is list or kind is tuple:
+                value = _jsonable(value)
+            new.append(value)
+        return new
+    if kind is str:
+        return obj.decode('utf-8')
+    return obj
+
+
+# Object serializers, by name: (dumps, loads). 'json' rows are stored as
+# text and every other codec as a blob. Objects are read back the way JSON
+# reads them, whatever codec stored them: marshal reads back what was
+# stored, so that is done on decode; msgpack reads back strings as unicode
+# and tuples as lists by itself, only keys other than strings are read back
+# as stored.
+CODECS = {'json': (json.dumps, json.loads),
+          'marshal': (lambda obj: marshal.dumps(obj, 2),
+                      lambda data: _jsonable(marshal.loads(data)))}
+
+if msgpack is not None:
+    _msgpack_args = _msgpack_loads_args()
+    CODECS['msgpack'] = (lambda obj: msgpack.packb(obj, use_bin_type=False),
+                         lambda data: msgpack.unpackb(data, use_list=True,
+                                                      **_msgpack_args))
+
+
+def register_codec(name, dumps, loads):
+    """Make a new object serializer available to the object store.
+
+    dumps(obj) must return a byte string and loads(data) the object back,
+    as json.loads() would return it.
+    """
+    CODECS[name] = (dumps, loads)
+
+
+def _encode(codec, obj):
+    # Returns the value and the codec to store in the row: rows written as
+    # JSON keep a NULL codec, like the ones written before codecs existed
+    data = CODECS[codec][0](obj)
+    if codec == 'json':
+        return data, None
+    return sqlite3.Binary(data), codec
+
+
+def _decode(codec, data):
+    if codec is None:
+        return json.loads(data)
+    return CODECS[codec][1](str(data))
+
+
+def _extract(codec, data, key):
+    # SQL function used to sort rows which JSON1 functions can not read
+    value = _decode(codec, data).get(key)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def _unicode(ident):
+    if isinstance(ident, str):
+        return ident.decode('utf-8')
+    return unicode(ident)
+
+
+def _unique(idents):
+    # Idents come back from SQLite as unicode, so compare them that way
+    seen = set()
+    return [i for i in map(_unicode, idents)
+            if not (i in seen or seen.add(i))]
+
+
+def _batches(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _index_values(value):
+    # Lists are indexed by each of their items, so that a field holding a
+    # list of users can be looked up by any of them
+    values = value if isinstance(value, list) else [value]
+    return [v for v in values if v is not None and
+            not isinstance(v, (dict, list))]
+
+
+def _matches(obj, criteria):
+    for field, value in criteria.iteritems():
+        found = obj.get(field)
+        if found != value and not (isinstance(found, list) and
+                                   value in found):
+            return False
+    return True
+
+
+def _prefix_matches(obj, prefixes):
+    for field, prefix in prefixes.iteritems():
+        if not any(isinstance(v, basestring) and v.startswith(prefix)
+                   for v in _index_values(obj.get(field))):
+            return False
+    return True
+
+
+def _ident_order(ident):
+    # Sort key of the idents in query(), which SQLite gets with
+    # CAST(id AS INTEGER), id
+    number = re.match(r'\s*([+-]?\d+)', ident)
+    return int(number.group(1)) if number else 0, ident
+
+
+def _cache_key(obj_type, ident):
+    return (_unicode(obj_type), _unicode(ident))
+
+
+def _copy(obj):
+    # Cheaper than copy.deepcopy() for the plain JSON types kept in the cache
+    if isinstance(obj, dict):
+        return dict((k, _copy(v)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return [_copy(v) for v in obj]
+    return obj
+
+
+def _columns(c, table):
+    return [x[1] for x in c.execute("PRAGMA table_info('%s')" % table)]
+
+
+def _create_objects(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS objects
+              (id TEXT, type TEXT, json TEXT, version TEXT,
+              PRIMARY KEY (id, type))''')
+
+
+def _add_codec_column(c):
+    # Rows written before the codec column have a NULL codec, which means
+    # JSON
+    if 'codec' not in _columns(c, 'objects'):
+        c.execute('ALTER TABLE objects ADD COLUMN codec TEXT')
+
+
+def _create_object_index(c):
+    # Secondary indexes: object_index_fields holds the indexed fields of
+    # each object type and object_index one row per indexed value
+    c.execute('''CREATE TABLE IF NOT EXISTS object_index_fields
+              (type TEXT, field TEXT, PRIMARY KEY (type, field))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS object_index
+              (type TEXT, id TEXT, field TEXT, value,
+              PRIMARY KEY (type, field, value, id))''')
+    c.execute('''CREATE INDEX IF NOT EXISTS object_index_ident
+              ON object_index (type, id)''')
+
+
+def _create_objects_type_index(c):
+    # Walks objects of a type in ident order, see get_list(after=)
+    c.execute('''CREATE INDEX IF NOT EXISTS objects_type
+              ON objects (type, id)''')
+
+
+def _add_updated_column(c):
+    # Time of the last store of each object, used to expire them
+    if 'updated' not in _columns(c, 'objects'):
+        c.execute('ALTER TABLE objects ADD COLUMN updated REAL')
+    c.execute('UPDATE objects SET updated=? WHERE updated IS NULL',
+              (time.time(),))
+
+
+def _add_rev_column(c):
+    # Revision of each object, increased on every store
+    if 'rev' not in _columns(c, 'objects'):
+        c.execute('ALTER TABLE objects ADD COLUMN rev INTEGER')
+    c.execute('UPDATE objects SET rev=1 WHERE rev IS NULL')
+
+
+def _create_object_search(c):
+    # Full-text search: object_search_fields holds the searchable fields of
+    # each object type and object_search_docs maps the rows of the
+    # object_fts table, created by ObjectStore.add_search(), to objects
+    c.execute('''CREATE TABLE IF NOT EXISTS object_search_fields
+              (type TEXT, field TEXT, PRIMARY KEY (type, field))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS object_search_docs
+              (docid INTEGER PRIMARY KEY, type TEXT, id TEXT,
+              UNIQUE (type, id))''')
+
+
+# Schema of the object store as (version, description, function) steps.
+# Databases created before schema versions were recorded run all of them,
+# so every step must cope with its change being already in place.
+SCHEMA_MIGRATIONS = [(1, 'create objects table', _create_objects),
+                     (2, 'add codec column', _add_codec_column),
+                     (3, 'create secondary index tables',
+                      _create_object_index),
+                     (4, 'index objects by type', _create_objects_type_index),
+                     (5, 'add updated column', _add_updated_column),
+                     (6, 'add rev column', _add_rev_column),
+                     (7, 'create full-text search tables',
+                      _create_object_search)]
+
+
+def _migrate(conn, namespace, migrations, location=None):
+    """Run the <migrations> of <namespace> not yet applied to the database
+    of <conn>, all in a single transaction.
+
+    <migrations> is a list of (version, description, function) tuples, each
+    function being called with a cursor. The last version applied of each
+    namespace is kept in the schema_version table. Return the number of
+    migrations run.
+    """
+    # Let the sqlite3 module leave DDL statements in the transaction
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    c = conn.cursor()
+    try:
+        c.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                  (namespace TEXT PRIMARY KEY, version INTEGER)''')
+        c.execute('BEGIN IMMEDIATE')
+        res = c.execute('SELECT version FROM schema_version WHERE '
+                        'namespace=?', (namespace,)).fetchall()
+        current = res[0][0] if res else 0
+        pending = sorted((m for m in migrations if m[0] > current),
+                         key=lambda m: m[0])
+        for version, description, fn in pending:
+            start = time.time()
+            fn(c)
+            wok_log.info("Objectstore %s: %s schema version %d (%s) "
+                         "applied in %.3fs" % (location, namespace, version,
+                                               description,
+                                               time.time() - start))
+        if pending:
+            c.execute('INSERT OR REPLACE INTO schema_version VALUES (?,?)',
+                      (namespace, pending[-1][0]))
+        c.execute('COMMIT')
+        return len(pending)
+    except:
+        c.execute('ROLLBACK')
+        raise
+    finally:
+        conn.isolation_level = isolation_level
+
+
+def _parse_ttls(value):
+    # "task:86400, vm:3600" -> {'task': 86400, 'vm': 3600}
+    ttls = {}
+    for item in value.split(','):
+        if item.strip():
+            obj_type, seconds = item.rsplit(':', 1)
+            ttls[obj_type.strip()] = int(seconds)
+    return ttls
+
+
+def add_columns(location, fields):
+    """Add TEXT columns <fields> to the objects table of the object store in
+    <location>, the ones that do not exist yet, in a single transaction.
+    Return the list of columns added.
+    """
+    conn = sqlite3.connect(location, timeout=10)
+    conn.isolation_level = None
+    c = conn.cursor()
+    try:
+        c.execute('BEGIN IMMEDIATE')
+        columns = _columns(c, 'objects')
+        added = [f for f in fields if f not in columns]
+        for field in added:
+            start = time.time()
+            c.execute('ALTER TABLE objects ADD COLUMN %s TEXT' % field)
+            wok_log.info("Objectstore %s: column %s added in %.3fs" %
+                         (location, field, time.time() - start))
+        c.execute('COMMIT')
+        return added
+    except:
+        c.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+class ObjectCache(object):
+    """LRU cache of decoded objects keyed by (type, ident).
+
+    Writes go through the cache (see put() and invalidate()). Objects read
+    from the database are added by fill(), which drops them if any write
+    went through the cache since the read started: a reader running in
+    parallel with a writer may have read the old version of the object.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._objects = OrderedDict()
+        self._lock = threading.Lock()
+        self._stripes = [threading.Lock() for i in xrange(CACHE_LOCK_STRIPES)]
+
+    @contextmanager
+    def locking(self, keys):
+        """Lock <keys> for writing.
+
+        Writers hold the locks of the objects they write from before the
+        database transaction until the cache is updated, so the cache is
+        updated in the same order as the database even when writers do not
+        hold the store lock. Writers to other objects are not blocked,
+        unless their keys share a lock.
+        """
+        stripes = sorted(set(hash(key) % len(self._stripes) for key in keys))
+        for i in stripes:
+            self._stripes[i].acquire()
+        try:
+            yield
+        finally:
+            for i in reversed(stripes):
+                self._stripes[i].release()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                obj = self._objects.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self._objects[key] = obj
+            self.hits += 1
+            return obj
+
+    def fill(self, key, obj, generation):
+        with self._lock:
+            if generation == self.generation:
+                self._insert(key, obj)
+
+    def put(self, key, obj):
+        with self._lock:
+            self.generation += 1
+            self._insert(key, obj)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._objects.pop(key, None)
+
+    def _insert(self, key, obj):
+        self._objects.pop(key, None)
+        self._objects[key] = obj
+        if len(self._objects) > self.size:
+            self._objects.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._objects), 'capacity': self.size,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class BaseSession(object):
+    """Object store session API implemented by every engine.
+
+    Engines implement get(), get_list(), store(), delete() and
+    get_object_version(). The batch methods work on top of them, one object
+    at a time, and may be overridden with faster versions.
+    """
+    def __init__(self, readonly=False):
+        self.readonly = readonly
+        # (obj_type, ident, event) of every change made in this session
+        self.changes = []
+
+    def _conflict(self, ident, expected, found):
+        raise ConflictError("WOKOBJST0009E", {'item': ident,
+                                              'expected': expected,
+                                              'found': found})
+
+    def _check_writable(self, ident):
+        if self.readonly:
+            raise OperationFailed("WOKOBJST0002E", {'item': ident})
+
+    def get(self, obj_type, ident):
+        raise NotImplementedError
+
+    def get_list(self, obj_type, sort_key=None, limit=None, offset=None,
+                 after=None):
+        raise NotImplementedError
+
+    def store(self, obj_type, ident, data, version=None, expected_rev=None):
+        raise NotImplementedError
+
+    def get_with_rev(self, obj_type, ident):
+        raise NotImplementedError
+
+    def delete(self, obj_type, ident, ignore_missing=False):
+        raise NotImplementedError
+
+    def get_object_version(self, obj_type, ident):
+        raise NotImplementedError
+
+    def get_types(self):
+        raise NotImplementedError
+
+    def get_many(self, obj_type, idents, ignore_missing=False):
+        objects = {}
+        for ident in _unique(idents):
+            try:
+                objects[ident] = self.get(obj_type, ident)
+            except NotFoundError:
+                if not ignore_missing:
+                    raise
+        return objects
+
+    def store_many(self, obj_type, objects, version=None):
+        if isinstance(objects, dict):
+            objects = objects.items()
+        for ident, data in objects:
+            self.store(obj_type, ident, data, version)
+
+    def delete_many(self, obj_type, idents, ignore_missing=False):
+        idents = _unique(idents)
+        if not ignore_missing:
+            # Check them all first, to delete nothing if one is missing
+            self.get_many(obj_type, idents)
+        for ident in idents:
+            self.delete(obj_type, ident, ignore_missing=True)
+
+    def find(self, obj_type, **criteria):
+        objects = self.get_many(obj_type, self.get_list(obj_type),
+                                ignore_missing=True)
+        return sorted(ident for ident, obj in objects.iteritems()
+                      if _matches(obj, criteria))
+
+    def query(self, obj_type, prefixes=None, limit=None, offset=None,
+              reverse=False, **criteria):
+        """Return (ident, object) for the objects of type <obj_type>
+        matching all <criteria>, as in find(), and whose fields in
+        <prefixes>, a dict of field: prefix, start with that prefix.
+
+        Objects are in ident order, idents starting with a number being
+        ordered by that number first, or in the reverse order if <reverse>
+        is set. <limit> and <offset> select a slice of them.
+        """
+        objects = [(ident, obj) for ident, obj in self.iter_objects(obj_type)
+                   if _matches(obj, criteria) and
+                   _prefix_matches(obj, prefixes or {})]
+        objects.sort(key=lambda (ident, obj): _ident_order(ident),
+                     reverse=reverse)
+        start = offset or 0
+        end = None if limit is None else start + limit
+        return objects[start:end]
+
+    def search(self, obj_type, query, limit=None):
+        """Return the idents of objects of type <obj_type> matching the
+        search <query>, at most <limit> of them.
+
+        Objects match when each word of <query> starts one of their words.
+        An empty query matches every object.
+        """
+        if not search_terms(query):
+            return self.get_list(obj_type, limit=limit)
+        return self._scan(obj_type, query, limit)
+
+    def _scan(self, obj_type, query, limit, fields=None):
+        idents = []
+        for ident, obj in self.iter_objects(obj_type):
+            if limit is not None and len(idents) >= limit:
+                break
+            if search_match(obj, query, fields):
+                idents.append(ident)
+        return idents
+
+    def iter_objects(self, obj_type, batch_size=QUERY_BATCH_SIZE):
+        after = None
+        while True:
+            if after is None:
+                idents = self.get_list(obj_type, limit=batch_size)
+            else:
+                idents = self.get_list(obj_type, limit=batch_size,
+                                       after=after)
+            objects = self.get_many(obj_type, idents, ignore_missing=True)
+            for ident in idents:
+                if ident in objects:
+                    yield ident, objects[ident]
+            if len(idents) < batch_size:
+                return
+            after = idents[-1]
+
+
+class ObjectStoreSession(BaseSession):
+    def __init__(self, conn, readonly=False, indexes=None, cache=None,
+                 codec='json', writer=None, optimistic=False, searches=None):
+        super(ObjectStoreSession, self).__init__(readonly)
         self.conn = conn
-        self.conn.text_factory = lambda x: unicode(x, "utf-8", "ignore")
+        self.indexes = {} if indexes is None else indexes
+        self.searches = {} if searches is None else searches
+        self.cache = cache
+        self.codec = codec
+        self.writer = writer
+        self.optimistic = optimistic
+
+    @contextmanager
+    def _locking(self, obj_type, idents):
+        if self.cache is None:
+            yield
+            return
+        with self.cache.locking([_cache_key(obj_type, i) for i in idents]):
+            yield
+
+    def _barrier(self):
+        # Queries other than get() only see committed objects, so commit the
+        # queued ones first
+        if self.writer is not None:
+            self.writer.flush()
+
+    def get_types(self):
+        """Return the types of the objects in the store."""
+        self._barrier()
+        c = self.conn.cursor()
+        res = c.execute('SELECT DISTINCT type FROM objects ORDER BY type')
+        return [x[0] for x in res]
 
     def _get_list(self, obj_type):
+        self._barrier()
         c = self.conn.cursor()
         res = c.execute('SELECT id FROM objects WHERE type=?', (obj_type,))
         return [x[0] for x in res]
 
-    def get_list(self, obj_type, sort_key=None):
-        ids = self._get_list(obj_type)
+    def get_list(self, obj_type, sort_key=None, limit=None, offset=None,
+                 after=None):
+        """Return the idents of all objects of type <obj_type>.
+
+        If <sort_key> is set, idents are ordered by that field of the stored
+        objects. <limit> and <offset> select a slice of the result, which is
+        then ordered by ident if no <sort_key> is given.
+
+        <after> pages through the idents in order: only the ones after it
+        are returned. Unlike <offset>, each page is as cheap as the first.
+        To walk all objects, pass the last ident of each page as <after>
+        of the next one until a page has less than <limit> idents.
+        """
+        if after is not None:
+            if sort_key is not None or offset is not None:
+                raise InvalidParameter("WOKOBJST0007E")
+            return self._get_page(obj_type, after, limit)
+
+        if sort_key is None and limit is None and offset is None:
+            return self._get_list(obj_type)
+
+        if sort_key is not None and not HAS_JSON1:
+            return self._get_list_sorted(obj_type, sort_key, limit, offset)
+
+        self._barrier()
+        sql = 'SELECT id FROM objects WHERE type=?'
+        args = [obj_type]
         if sort_key is None:
-            return ids
-        objects = [(ident, self.get(obj_type, ident)) for ident in ids]
-        objects.sort(key=lambda (_, obj): obj[sort_key])
-        return [ident for ident, _ in objects]
+            sql += ' ORDER BY id'
+        else:
+            sql += (' ORDER BY CASE WHEN codec IS NULL THEN '
+                    'json_extract(json, ?) ELSE wok_extract(codec, json, ?) '
+                    'END, id')
+            args += ['$."%s"' % sort_key, sort_key]
+        if limit is not None or offset is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            args += [-1 if limit is None else limit, offset or 0]
+
+        c = self.conn.cursor()
+        return [x[0] for x in c.execute(sql, args)]
+
+    def _get_page(self, obj_type, after, limit):
+        self._barrier()
+        c = self.conn.cursor()
+        res = c.execute('SELECT id FROM objects WHERE type=? AND id>? '
+                        'ORDER BY id LIMIT ?',
+                        (obj_type, after, -1 if limit is None else limit))
+        return [x[0] for x in res]
+
+    def iter_objects(self, obj_type, batch_size=QUERY_BATCH_SIZE):
+        """Yield (ident, object) for all objects of type <obj_type>, in ident
+        order.
+
+        Objects are read <batch_size> at a time, so memory use does not grow
+        with the number of objects. The generator must be consumed before
+        the session is closed. Objects stored or deleted meanwhile may or
+        may not be seen.
+        """
+        self._barrier()
+        sql = ('SELECT id, json, codec FROM objects WHERE type=? %s '
+               'ORDER BY id LIMIT ?')
+        c = self.conn.cursor()
+        rows = c.execute(sql % '', (obj_type, batch_size)).fetchall()
+        while True:
+            for ident, data, codec in rows:
+                yield ident, _decode(codec, data)
+            if len(rows) < batch_size:
+                return
+            rows = c.execute(sql % 'AND id>?',
+                             (obj_type, rows[-1][0], batch_size)).fetchall()
+
+    def _get_list_sorted(self, obj_type, sort_key, limit, offset):
+        # Fallback for SQLite builds without the JSON1 extension
+        self._barrier()
+        c = self.conn.cursor()
+        res = c.execute('SELECT id, json, codec FROM objects WHERE type=?',
+                        (obj_type,))
+        objects = [(ident, _decode(codec, data)) for ident, data, codec in res]
+        objects.sort(key=lambda (ident, obj): (obj.get(sort_key), ident))
+        start = offset or 0
+        end = None if limit is None else start + limit
+        return [ident for ident, _ in objects[start:end]]
 
     def get(self, obj_type, ident):
+        if self.writer is not None:
+            try:
+                return _copy(self.writer.get(_cache_key(obj_type, ident)))
+            except KeyError:
+                pass
+
+        if self.cache is not None:
+            key = _cache_key(obj_type, ident)
+            generation = self.cache.generation
+            try:
+                return _copy(self.cache.get(key))
+            except KeyError:
+                pass
+
         c = self.conn.cursor()
-        res = c.execute('SELECT json FROM objects WHERE type=? AND id=?',
-                        (obj_type, ident))
+        res = c.execute('SELECT json, codec FROM objects WHERE type=? AND '
+                        'id=?', (obj_type, ident))
         try:
-            jsonstr = res.fetchall()[0][0]
+            data, codec = res.fetchall()[0]
         except IndexError:
             self.conn.rollback()
             raise NotFoundError("WOKOBJST0001E", {'item': ident})
-        return json.loads(jsonstr)
+
+        obj = _decode(codec, data)
+        if self.cache is not None:
+            self.cache.fill(key, _copy(obj), generation)
+        return obj
+
+    def get_with_rev(self, obj_type, ident):
+        """Return the object <ident> and its revision, to be passed as
+        <expected_rev> to store() after changing it.
+        """
+        self._barrier()
+        c = self.conn.cursor()
+        res = c.execute('SELECT json, codec, rev FROM objects WHERE type=? '
+                        'AND id=?', (obj_type, ident))
+        try:
+            data, codec, rev = res.fetchall()[0]
+        except IndexError:
+            raise NotFoundError("WOKOBJST0001E", {'item': ident})
+        return _decode(codec, data), rev
+
+    def get_many(self, obj_type, idents, ignore_missing=False):
+        """Return a dict mapping each ident in <idents> to its object.
+
+        Objects are fetched with one query per batch of QUERY_BATCH_SIZE
+        idents. Missing objects raise NotFoundError unless <ignore_missing>
+        is set, in which case they are left out of the result.
+        """
+        idents = _unique(idents)
+        objects = {}
+        pending = idents
+        if self.writer is not None:
+            pending = []
+            for ident in idents:
+                try:
+                    obj = self.writer.get(_cache_key(obj_type, ident))
+                    objects[ident] = _copy(obj)
+                except KeyError:
+                    pending.append(ident)
+
+        if self.cache is not None:
+            generation = self.cache.generation
+            idents_left, pending = pending, []
+            for ident in idents_left:
+                try:
+                    obj = self.cache.get(_cache_key(obj_type, ident))
+                    objects[ident] = _copy(obj)
+                except KeyError:
+                    pending.append(ident)
+
+        c = self.conn.cursor()
+        for batch in _batches(pending, QUERY_BATCH_SIZE):
+            sql = ('SELECT id, json, codec FROM objects WHERE type=? AND id '
+                   'IN (%s)')
+            res = c.execute(sql % ','.join('?' * len(batch)),
+                            [obj_type] + batch)
+            for ident, data, codec in res:
+                objects[ident] = _decode(codec, data)
+                if self.cache is not None:
+                    self.cache.fill(_cache_key(obj_type, ident),
+                                    _copy(objects[ident]), generation)
+
+        if not ignore_missing and len(objects) != len(idents):
+            missing = [i for i in idents if i not in objects][0]
+            raise NotFoundError("WOKOBJST0001E", {'item': missing})
+        return objects
+
+    def find(self, obj_type, **criteria):
+        """Return the idents of objects of type <obj_type> matching all
+        <criteria>.
+
+        A criterion field=value matches objects whose field is equal to
+        value or, for list fields, contains it. Criteria on fields declared
+        with ObjectStore.add_index() are resolved by the index; the others
+        are checked against the objects left after that.
+        """
+        indexed = self.indexes.get(_unicode(obj_type), ())
+        lookups = [(f, v) for f, v in criteria.iteritems() if f in indexed]
+        others = dict((f, v) for f, v in criteria.iteritems()
+                      if f not in indexed)
+
+        self._barrier()
+        c = self.conn.cursor()
+        if lookups:
+            sql = ' INTERSECT '.join(['SELECT id FROM object_index WHERE '
+                                      'type=? AND field=? AND value=?'] *
+                                     len(lookups))
+            args = []
+            for field, value in lookups:
+                args += [obj_type, field, value]
+            if not others:
+                return [x[0] for x in c.execute(sql, args)]
+
+            sql = ('SELECT id, json, codec FROM objects WHERE type=? AND id '
+                   'IN (%s)' % sql)
+            res = c.execute(sql, [obj_type] + args)
+        else:
+            res = c.execute('SELECT id, json, codec FROM objects WHERE type=?',
+                            (obj_type,))
+
+        return [ident for ident, data, codec in res
+                if _matches(_decode(codec, data), others)]
+
+    def query(self, obj_type, prefixes=None, limit=None, offset=None,
+              reverse=False, **criteria):
+        """Return (ident, object) for the objects of type <obj_type>
+        matching all <criteria>, as in find(), and whose fields in
+        <prefixes>, a dict of field: prefix, start with that prefix.
+
+        Objects are in ident order, idents starting with a number being
+        ordered by that number first, or in the reverse order if <reverse>
+        is set. <limit> and <offset> select a slice of them.
+
+        Objects are read with a single query. Criteria and prefixes on
+        fields declared with ObjectStore.add_index() are resolved by the
+        index, and so are <limit> and <offset> when there are no others.
+        """
+        indexed = self.indexes.get(_unicode(obj_type), ())
+        sql = 'SELECT id, json, codec FROM objects WHERE type=?'
+        args = [obj_type]
+        others = {}
+        for field, value in criteria.iteritems():
+            if field in indexed:
+                sql += (' AND id IN (SELECT id FROM object_index WHERE '
+                        'type=? AND field=? AND value=?)')
+                args += [obj_type, field, value]
+            else:
+                others[field] = value
+        other_prefixes = {}
+        for field, prefix in (prefixes or {}).iteritems():
+            prefix = _unicode(prefix)
+            if field in indexed:
+                # The range lets SQLite use the index
+                sql += (' AND id IN (SELECT id FROM object_index WHERE '
+                        'type=? AND field=? AND value>=? AND '
+                        'substr(value, 1, ?)=?)')
+                args += [obj_type, field, prefix, len(prefix), prefix]
+            else:
+                other_prefixes[field] = prefix
+        order = ' DESC' if reverse else ''
+        sql += ' ORDER BY CAST(id AS INTEGER)%s, id%s' % (order, order)
+        filtered = others or other_prefixes
+        if not filtered and (limit is not None or offset is not None):
+            sql += ' LIMIT ? OFFSET ?'
+            args += [-1 if limit is None else limit, offset or 0]
+
+        self._barrier()
+        c = self.conn.cursor()
+        objects = [(ident, _decode(codec, data))
+                   for ident, data, codec in c.execute(sql, args)]
+        if not filtered:
+            return objects
+
+        objects = [(ident, obj) for ident, obj in objects
+                   if _matches(obj, others) and
+                   _prefix_matches(obj, other_prefixes)]
+        start = offset or 0
+        end = None if limit is None else start + limit
+        return objects[start:end]
+
+    def _update_index(self, c, obj_type, objects):
+        # Replaces the index entries of <objects>, a list of (ident, object)
+        # tuples. Deleted objects have None in place of the object.
+        fields = self.indexes.get(_unicode(obj_type))
+        if not fields:
+            return
+
+        c.executemany('DELETE FROM object_index WHERE type=? AND id=?',
+                      [(obj_type, ident) for ident, _ in objects])
+        rows = []
+        for ident, data in objects:
+            if not isinstance(data, dict):
+                continue
+            for field in fields:
+                for value in _index_values(data.get(field)):
+                    rows.append((obj_type, ident, field, value))
+        c.executemany('''INSERT OR IGNORE INTO object_index
+                      (type, id, field, value) VALUES (?,?,?,?)''', rows)
+
+    def search(self, obj_type, query, limit=None):
+        """Return the idents of objects of type <obj_type> matching the
+        search <query>, at most <limit> of them.
+
+        Objects match when each word of <query> starts a word of one of
+        their fields declared with ObjectStore.add_search(). The most
+        relevant ones come first if SQLite has FTS5, otherwise they are in
+        ident order. Types with no declared fields, or SQLite builds without
+        full-text search, fall back to checking every object, on all their
+        fields in the first case. An empty query matches every object.
+        """
+        terms = search_terms(query)
+        if not terms:
+            return self.get_list(obj_type, limit=limit)
+        fields = self.searches.get(_unicode(obj_type))
+        if not fields or FTS is None:
+            return self._scan(obj_type, query, limit, fields)
+
+        self._barrier()
+        sql = ('SELECT d.id FROM object_fts JOIN object_search_docs d ON '
+               'd.docid=object_fts.rowid WHERE object_fts MATCH ? AND '
+               'd.type=? ORDER BY %s LIMIT ?' %
+               ('object_fts.rank' if FTS == 'fts5' else 'd.id'))
+        match = ' '.join(t + '*' for t in terms)
+        c = self.conn.cursor()
+        res = c.execute(sql, (match, obj_type,
+                              -1 if limit is None else limit))
+        return [x[0] for x in res]
+
+    def _update_search(self, c, obj_type, objects):
+        # Replaces the full-text search entries of <objects>, a list of
+        # (ident, object) tuples. Deleted objects have None in place of
+        # the object.
+        fields = self.searches.get(_unicode(obj_type))
+        if not fields or FTS is None:
+            return
+
+        fields = sorted(fields)
+        for ident, data in objects:
+            res = c.execute('SELECT docid FROM object_search_docs WHERE '
+                            'type=? AND id=?', (obj_type, ident)).fetchall()
+            if res:
+                docid = res[0][0]
+                c.execute('DELETE FROM object_fts WHERE rowid=?', (docid,))
+            if not isinstance(data, dict):
+                if res:
+                    c.execute('DELETE FROM object_search_docs WHERE docid=?',
+                              (docid,))
+                continue
+            if not res:
+                c.execute('INSERT INTO object_search_docs (type, id) VALUES '
+                          '(?,?)', (obj_type, ident))
+                docid = c.lastrowid
+            c.execute('INSERT INTO object_fts (rowid, content) VALUES (?,?)',
+                      (docid, ' '.join(search_text(data, fields))))
 
     def get_object_version(self, obj_type, ident):
+        self._barrier()
         c = self.conn.cursor()
         res = c.execute('SELECT version FROM objects WHERE type=? AND id=?',
                         (obj_type, ident))
         return [x[0] for x in res]
 
     def delete(self, obj_type, ident, ignore_missing=False):
+        self._check_writable(ident)
+        self._barrier()
+        with self._locking(obj_type, [ident]):
+            c = self.conn.cursor()
+            c.execute('DELETE FROM objects WHERE type=? AND id=?',
+                      (obj_type, ident))
+            if c.rowcount != 1 and not ignore_missing:
+                self.conn.rollback()
+                raise NotFoundError("WOKOBJST0001E", {'item': ident})
+            deleted = c.rowcount == 1
+            self._update_index(c, obj_type, [(ident, None)])
+            self._update_search(c, obj_type, [(ident, None)])
+            self.conn.commit()
+            if self.cache is not None:
+                self.cache.invalidate(_cache_key(obj_type, ident))
+        if deleted:
+            self.changes.append((obj_type, ident, 'delete'))
+
+    def delete_many(self, obj_type, idents, ignore_missing=False):
+        """Delete all objects in <idents> in a single transaction.
+
+        If any of them does not exist, nothing is deleted and NotFoundError
+        is raised, unless <ignore_missing> is set.
+        """
+        idents = _unique(idents)
+        if not idents:
+            return
+        self._check_writable(idents[0])
+        self._barrier()
+
+        with self._locking(obj_type, idents):
+            self._delete_rows(obj_type, idents, ignore_missing)
+            if self.cache is not None:
+                for ident in idents:
+                    self.cache.invalidate(_cache_key(obj_type, ident))
+        self.changes.extend((obj_type, ident, 'delete') for ident in idents)
+
+    def _delete_rows(self, obj_type, idents, ignore_missing):
         c = self.conn.cursor()
-        c.execute('DELETE FROM objects WHERE type=? AND id=?',
-                  (obj_type, ident))
-        if c.rowcount != 1 and not ignore_missing:
+        try:
+            c.executemany('DELETE FROM objects WHERE type=? AND id=?',
+                          [(obj_type, ident) for ident in idents])
+            if c.rowcount != len(idents) and not ignore_missing:
+                self.conn.rollback()
+                found = self.get_many(obj_type, idents, ignore_missing=True)
+                missing = [i for i in idents if i not in found][0]
+                raise NotFoundError("WOKOBJST0001E", {'item': missing})
+            self._update_index(c, obj_type,
+                               [(ident, None) for ident in idents])
+            self._update_search(c, obj_type,
+                                [(ident, None) for ident in idents])
+            self.conn.commit()
+        except sqlite3.Error:
             self.conn.rollback()
-            raise NotFoundError("WOKOBJST0001E", {'item': ident})
-        self.conn.commit()
+            raise
+
+    def store(self, obj_type, ident, data, version=None, expected_rev=None):
+        """Store <data> as the object <ident>, increasing its revision.
+
+        If <expected_rev> is set, the object is only stored if its current
+        revision is <expected_rev> (0 for an object which does not exist).
+        Otherwise it was changed since it was read and ConflictError is
+        raised: read it again, with get_with_rev(), and retry.
+        """
+        self._check_writable(ident)
+
+        # Get Wok version if none was provided
+        if version is None:
+            version = config.get_version().split('-')[0]
+
+        if (self.writer is not None and expected_rev is None and
+                not self.optimistic):
+            self.writer.put(obj_type, ident, data, version)
+        else:
+            self._barrier()
+            self._write_rows([(ident, obj_type) + _encode(self.codec, data) +
+                              (version, data)], expected_rev)
+        self.changes.append((obj_type, ident, 'store'))
+
+    def store_many(self, obj_type, objects, version=None):
+        """Store all objects in <objects> in a single transaction.
+
+        <objects> is either a dict mapping idents to objects or a list of
+        (ident, object) tuples. Existing objects are replaced.
+        """
+        if isinstance(objects, dict):
+            objects = objects.items()
+        if not objects:
+            return
+        self._check_writable(objects[0][0])
+        self._barrier()
 
-    def store(self, obj_type, ident, data, version=None):
         # Get Wok version if none was provided
         if version is None:
             version = config.get_version().split('-')[0]
 
-        jsonstr = json.dumps(data)
+        self._write_rows([(ident, obj_type) + _encode(self.codec, data) +
+                          (version, data) for ident, data in objects])
+        self.changes.extend((obj_type, ident, 'store')
+                            for ident, _ in objects)
+
+    def _write_rows(self, rows, expected_rev=None):
+        # Stores <rows> of (ident, obj_type, encoded, codec, version, obj)
+        # in a single transaction
+        if self.cache is None:
+            self._insert_rows(rows, expected_rev)
+            return
+
+        with self.cache.locking([_cache_key(r[1], r[0]) for r in rows]):
+            self._insert_rows(rows, expected_rev)
+            # Cache what a read would return, e.g. lists instead of tuples
+            for ident, obj_type, encoded, codec, _, _ in rows:
+                self.cache.put(_cache_key(obj_type, ident),
+                               _decode(codec, encoded))
+
+    def _insert_rows(self, rows, expected_rev):
         c = self.conn.cursor()
-        c.execute('DELETE FROM objects WHERE type=? AND id=?',
-                  (obj_type, ident))
-        c.execute('''INSERT INTO objects (id, type, json, version)
-                  VALUES (?,?,?,?)''',
-                  (ident, obj_type, jsonstr, version))
-        self.conn.commit()
+        try:
+            now = time.time()
+            if expected_rev is None:
+                c.executemany('''INSERT OR REPLACE INTO objects
+                              (id, type, json, codec, version, updated, rev)
+                              VALUES (?,?,?,?,?,?, 1 + COALESCE((SELECT rev
+                              FROM objects WHERE id=? AND type=?), 0))''',
+                              [row[:5] + (now,) + row[:2] for row in rows])
+            else:
+                self._compare_and_swap(c, rows[0], now, expected_rev)
+            by_type = {}
+            for ident, obj_type, _, _, _, obj in rows:
+                by_type.setdefault(obj_type, []).append((ident, obj))
+            for obj_type, objects in by_type.iteritems():
+                self._update_index(c, obj_type, objects)
+                self._update_search(c, obj_type, objects)
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+
+    def _compare_and_swap(self, c, row, now, expected_rev):
+        ident, obj_type, encoded, codec, version, _ = row
+        if expected_rev == 0:
+            c.execute('''INSERT OR IGNORE INTO objects
+                      (id, type, json, codec, version, updated, rev)
+                      VALUES (?,?,?,?,?,?,1)''', row[:5] + (now,))
+        else:
+            c.execute('''UPDATE objects SET json=?, codec=?, version=?,
+                      updated=?, rev=rev+1 WHERE id=? AND type=? AND
+                      rev=?''',
+                      (encoded, codec, version, now, ident, obj_type,
+                       expected_rev))
+        if c.rowcount != 1:
+            self.conn.rollback()
+            res = c.execute('SELECT rev FROM objects WHERE id=? AND type=?',
+                            (ident, obj_type)).fetchall()
+            self._conflict(ident, expected_rev, res[0][0] if res else 0)
+
+
+class GroupCommitWriter(object):
+    """Commits object stores in groups from a single thread.
+
+    put() queues a store and returns immediately. The writer thread commits
+    all queued stores in a single transaction once <interval> seconds have
+    passed since the first of them was queued, or as soon as <size> objects
+    are queued. Repeated stores of the same object before a commit only
+    write its last version.
+
+    Queued objects are visible to get() through the session, which reads
+    them from here first. flush() is a durability barrier: it returns once
+    every store queued before it was called is committed.
+
+    The writer commits through a connection of its own, outside the pool of
+    the store: sessions holding every connection of the pool may be waiting
+    for it to commit.
+    """
+    def __init__(self, store, interval, size):
+        self.store = store
+        self.interval = interval
+        self.size = size
+        self.conn = None
+        self._pending = OrderedDict()
+        self._queued = 0
+        self._committed = 0
+        self._flushing = False
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def put(self, obj_type, ident, data, version):
+        # Encode right away: the caller may change <data> after storing it
+        encoded, codec = _encode(self.store.codec, data)
+        row = (ident, obj_type, encoded, codec, version,
+               _decode(codec, encoded))
+        key = _cache_key(obj_type, ident)
+        with self._cond:
+            self._pending.pop(key, None)
+            self._pending[key] = row
+            self._queued += 1
+            self._cond.notify_all()
+
+    def get(self, key):
+        with self._cond:
+            return self._pending[key][5]
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        deadline = time.time() + timeout
+        with self._cond:
+            target = self._queued
+            self._flushing = True
+            self._cond.notify_all()
+            while self._committed < target:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise OperationFailed("WOKOBJST0006E",
+                                          {'seconds': timeout})
+                self._cond.wait(remaining)
+
+    def stop(self, timeout=FLUSH_TIMEOUT):
+        """Commit the queued objects and end the writer thread."""
+        with self._cond:
+            self._stopping = True
+            self._flushing = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = self.store._pool._connect()
+        return self.conn
+
+    def _disconnect(self):
+        if self.conn is not None:
+            self.store._pool._close(self.conn)
+            self.conn = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if not self._pending:
+                    break
+                deadline = time.time() + self.interval
+                while not self._flushing and len(self._pending) < self.size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                rows = self._pending.values()
+                queued = self._queued
+
+            try:
+                with self.store._session(committer=True) as session:
+                    session._write_rows(rows)
+            except Exception:
+                wok_log.error("Objectstore %s: unable to commit %d queued "
+                              "objects" % (self.store.location, len(rows)))
+                wok_log.error(traceback.format_exc())
+                # Start over on a new connection
+                self._disconnect()
+                time.sleep(self.interval)
+                continue
+
+            with self._cond:
+                # Objects stored again meanwhile stay queued
+                for row in rows:
+                    key = _cache_key(row[1], row[0])
+                    if self._pending.get(key) is row:
+                        del self._pending[key]
+                self._committed = queued
+                if self._committed == self._queued and not self._stopping:
+                    self._flushing = False
+                self._cond.notify_all()
+
+        self._disconnect()
+
+
+class ChangeWatch(object):
+    """Waitable subscription to changes of objects in an ObjectStore.
+
+    Created by ObjectStore.watch(). Changes made after it is created are
+    recorded, so a caller may check the current state of an object and
+    then wait without missing a change made in between.
+    """
+    def __init__(self, store, obj_type, ident=None):
+        self.store = store
+        self._event = threading.Event()
+        self._token = store.subscribe(obj_type, self._changed, ident)
+
+    def _changed(self, obj_type, ident, event):
+        self._event.set()
+
+    def wait(self, timeout=None):
+        """Wait for a change. Return False if <timeout> seconds passed
+        without any, True otherwise."""
+        changed = self._event.wait(timeout)
+        self._event.clear()
+        return changed
+
+    def close(self):
+        self.store.unsubscribe(self._token)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+class ConnectionPool(object):
+    """Bounded pool of SQLite connections to a single database file.
+
+    Connections are not bound to a thread: a session checks one out, uses it
+    and checks it back in, so short-lived threads (like the ones running
+    async tasks) reuse warm connections instead of opening new ones. At most
+    <size> connections exist at the same time; once all of them are in use,
+    checkout() waits up to <timeout> seconds for one to be returned.
+    """
+    def __init__(self, location, size, timeout=10, setup=None):
+        self.location = location
+        self.size = size
+        self.timeout = timeout
+        self.created = 0
+        self._setup = setup
+        self._idle = []
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.location, timeout=self.timeout,
+                               check_same_thread=False)
+        conn.text_factory = lambda x: unicode(x, "utf-8", "ignore")
+        if self._setup is not None:
+            self._setup(conn)
+        return conn
+
+    def _is_healthy(self, conn):
+        try:
+            conn.execute('SELECT 1').fetchall()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def checkout(self):
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while not self._idle and self.created >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise OperationFailed("WOKOBJST0004E",
+                                          {'size': self.size,
+                                           'seconds': self.timeout})
+                self._cond.wait(remaining)
+
+            if self._idle:
+                conn, idle_since = self._idle.pop()
+                if time.time() - idle_since < HEALTH_CHECK_IDLE_TIME:
+                    return conn
+            else:
+                conn = None
+                self.created += 1
+
+        # Idle connections are checked before being handed out again and
+        # replaced if they turned unusable
+        if conn is not None:
+            if self._is_healthy(conn):
+                return conn
+            self._close(conn)
+
+        try:
+            return self._connect()
+        except:
+            self._release_slot()
+            raise
+
+    def checkin(self, conn, broken=False):
+        # Never hand out a connection with a pending transaction
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            broken = True
+
+        if broken and not self._is_healthy(conn):
+            self._close(conn)
+            self._release_slot()
+            return
+
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def _release_slot(self):
+        with self._cond:
+            self.created -= 1
+            self._cond.notify()
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self.created -= len(idle)
+        for conn, _ in idle:
+            self._close(conn)
+
+
+class BaseStore(object):
+    """Base class of object store engines.
+
+    Engines implement _session(readonly) as a context manager yielding a
+    BaseSession, and get change notifications, read-only sessions and
+    per-thread session handling from here.
+
+    Usage:
+        with objstore as session:
+            session.store('task', id, obj)
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._subscribers = {}
+        self._subscribers_lock = threading.Lock()
+
+    def _session(self, readonly=False):
+        raise NotImplementedError
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Wait until every object stored so far is on disk."""
+        pass
+
+    def close(self):
+        """Stop the background work of the store."""
+        pass
+
+    def add_index(self, obj_type, *fields):
+        """Hint that objects of <obj_type> are looked up by <fields>."""
+        pass
+
+    def add_search(self, obj_type, *fields):
+        """Hint that objects of <obj_type> are searched by <fields>."""
+        pass
+
+    def keep(self, obj_type, fn):
+        """Hint that objects of <obj_type> for which fn(object) is true
+        are not to be deleted when they expire."""
+        pass
 
+    def subscribe(self, obj_type, fn, ident=None):
+        """Call fn(obj_type, ident, event) whenever an object of <obj_type>
+        is stored or deleted in this process, or only the object <ident> if
+        given. <event> is either 'store' or 'delete'.
 
-class ObjectStore(object):
-    def __init__(self, location=None):
+        Callbacks run in the thread that made the change, once its session
+        is closed, so they may open sessions themselves. Return a token to
+        pass to unsubscribe().
+        """
+        key = (_unicode(obj_type), None if ident is None else _unicode(ident))
+        token = object()
+        with self._subscribers_lock:
+            self._subscribers.setdefault(key, {})[token] = fn
+        return key, token
+
+    def unsubscribe(self, token):
+        key, token = token
+        with self._subscribers_lock:
+            callbacks = self._subscribers.get(key, {})
+            callbacks.pop(token, None)
+            if not callbacks:
+                self._subscribers.pop(key, None)
+
+    def watch(self, obj_type, ident=None):
+        """Return a ChangeWatch on objects of <obj_type>, or only on the
+        object <ident> if given.
+
+        Usage:
+            with objstore.watch('task', id) as watch:
+                while not done():
+                    watch.wait(timeout)
+        """
+        return ChangeWatch(self, obj_type, ident)
+
+    def _notify(self, changes):
+        if not changes or not self._subscribers:
+            return
+
+        for obj_type, ident, event in changes:
+            obj_type, ident = _unicode(obj_type), _unicode(ident)
+            with self._subscribers_lock:
+                callbacks = []
+                for key in ((obj_type, ident), (obj_type, None)):
+                    callbacks.extend(self._subscribers.get(key, {}).values())
+            for fn in callbacks:
+                try:
+                    fn(obj_type, ident, event)
+                except Exception:
+                    wok_log.error("Objectstore %s: error notifying change of "
+                                  "%s %s" % (self.location, obj_type, ident))
+                    wok_log.error(traceback.format_exc())
+
+    def reader(self):
+        """Open a read-only session."""
+        return self._session(readonly=True)
+
+    def export_objects(self, fileobj, obj_types=None,
+                       batch_size=QUERY_BATCH_SIZE):
+        """Write all objects of <obj_types>, or of every type, to <fileobj>
+        as JSON lines and return how many were written.
+
+        Objects are read <batch_size> at a time, each batch in its own
+        read-only session, so memory use stays constant and writers are
+        never held back for long. Objects stored or deleted meanwhile may or
+        may not be exported.
+        """
+        if obj_types is None:
+            with self.reader() as session:
+                obj_types = session.get_types()
+
+        count = 0
+        for obj_type in obj_types:
+            after = None
+            while True:
+                with self.reader() as session:
+                    idents = session.get_list(obj_type, limit=batch_size,
+                                              after=after)
+                    objects = session.get_many(obj_type, idents,
+                                               ignore_missing=True)
+                for ident in idents:
+                    if ident in objects:
+                        record = {'type': obj_type, 'id': ident,
+                                  'object': objects[ident]}
+                        fileobj.write(json.dumps(record) + '\n')
+                        count += 1
+                if len(idents) < batch_size:
+                    break
+                after = idents[-1]
+        return count
+
+    def import_objects(self, fileobj, batch_size=QUERY_BATCH_SIZE):
+        """Store the objects written to <fileobj> by export_objects() and
+        return how many were stored.
+
+        Objects are stored <batch_size> at a time, each batch in its own
+        session. Existing objects with the same type and ident are
+        replaced.
+        """
+        count = 0
+        batches = {}
+        for line in fileobj:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            batch = batches.setdefault(record['type'], [])
+            batch.append((record['id'], record['object']))
+            if len(batch) >= batch_size:
+                with self as session:
+                    session.store_many(record['type'], batch)
+                count += len(batch)
+                del batch[:]
+
+        for obj_type, batch in batches.iteritems():
+            if batch:
+                with self as session:
+                    session.store_many(obj_type, batch)
+                count += len(batch)
+        return count
+
+    def optimistic(self):
+        """Open a session for optimistic writers.
+
+        Use store() with <expected_rev> in it: conflicting writes are then
+        detected instead of prevented by holding the store lock.
+
+        Usage:
+            with objstore.optimistic() as session:
+                obj, rev = session.get_with_rev('vm', id)
+                obj['name'] = name
+                session.store('vm', id, obj, expected_rev=rev)
+        """
+        return self._session()
+
+    def __enter__(self):
+        # Sessions are used by many threads at once, so keep each thread's
+        # open sessions aside until __exit__ is called
+        ctx = self._session()
+        session = ctx.__enter__()
+        try:
+            self._local.sessions.append(ctx)
+        except AttributeError:
+            self._local.sessions = [ctx]
+        return session
+
+    def __exit__(self, type, value, tb):
+        ctx = self._local.sessions.pop()
+        # Logs database errors and returns False, which makes __exit__ raise
+        # the exception again
+        return ctx.__exit__(type, value, tb)
+
+
+class ObjectStore(BaseStore):
+    def __init__(self, location=None, concurrency=None, pool_size=None,
+                 cache_size=None, codec=None, group_commit=None,
+                 maintenance_interval=None, codec_migration=False):
+        if concurrency is None:
+            concurrency = configParser.get('objectstore', 'concurrency')
+        if concurrency not in CONCURRENCY_MODES:
+            raise InvalidParameter("WOKOBJST0003E",
+                                   {'mode': concurrency,
+                                    'modes': ', '.join(CONCURRENCY_MODES)})
+        if pool_size is None:
+            pool_size = configParser.getint('objectstore', 'pool_size')
+        if cache_size is None:
+            cache_size = configParser.getint('objectstore', 'cache_size')
+        if codec is None:
+            codec = configParser.get('objectstore', 'codec')
+        if codec not in CODECS:
+            raise InvalidParameter("WOKOBJST0005E",
+                                   {'codec': codec,
+                                    'codecs': ', '.join(sorted(CODECS))})
+        if group_commit is None:
+            group_commit = configParser.getboolean('objectstore',
+                                                   'group_commit')
+        super(ObjectStore, self).__init__()
         self._lock = threading.Semaphore()
-        self._connections = OrderedDict()
+        self._writer = None
+        self._indexes = {}
+        self._searches = {}
+        # Functions telling which objects of each type purge_expired() keeps
+        self._keep = {}
+        self.cache = ObjectCache(cache_size) if cache_size > 0 else None
+        self.concurrency = concurrency
+        self.codec = codec
+        self.ttls = _parse_ttls(configParser.get('objectstore', 'ttl'))
         self.location = location or config.get_object_store()
+        self._pool = ConnectionPool(self.location, pool_size,
+                                    setup=self._setup_conn)
         with self._lock:
             self._init_db()
 
+        # Set by close() to stop the background work of the store
+        self._closing = threading.Event()
+        self._codec_migration = None
+        if codec_migration and self._needs_codec_migration():
+            self._codec_migration = threading.Thread(
+                target=self._codec_migration_helper)
+            self._codec_migration.setDaemon(True)
+            self._codec_migration.start()
+
+        if group_commit:
+            interval = configParser.getint('objectstore',
+                                           'group_commit_interval')
+            size = configParser.getint('objectstore', 'group_commit_size')
+            self._writer = GroupCommitWriter(self, interval / 1000.0, size)
+
+        # Only the store of the daemon runs maintenance by default, see
+        # open_objectstore()
+        self.maintenance_task = None
+        if maintenance_interval:
+            self.maintenance_task = BackgroundTask(maintenance_interval,
+                                                   self.maintenance)
+            self.maintenance_task.start()
+
+    def close(self):
+        """Stop the background work of the store, and wait for it to end.
+        Sessions may still be opened afterwards, and commit their stores
+        right away."""
+        self._closing.set()
+        if self.maintenance_task is not None:
+            self.maintenance_task.cancel()
+        if self._codec_migration is not None:
+            self._codec_migration.join()
+        # Queued objects are committed before the writer thread ends
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer = None
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Wait until every object stored so far is committed.
+
+        In group commit mode stores are committed asynchronously, a few at a
+        time. Call flush() where an object must be on disk before going on.
+        Raises OperationFailed if that takes more than <timeout> seconds.
+        Outside group commit mode stores are committed right away and this
+        does nothing.
+        """
+        if self._writer is not None:
+            self._writer.flush(timeout)
+
+    def _setup_conn(self, conn):
+        conn.create_function('wok_extract', 3, _extract)
+        if self.concurrency == 'wal':
+            # In WAL mode a NORMAL sync level is safe from corruption and
+            # avoids one fsync per commit
+            conn.execute('PRAGMA synchronous=NORMAL')
+
     def _init_db(self):
-        conn = self._get_conn()
+        conn = self._pool.checkout()
+        try:
+            self._create_schema(conn)
+        finally:
+            self._pool.checkin(conn)
+
+    def _create_schema(self, conn):
         c = conn.cursor()
-        c.execute('''SELECT * FROM sqlite_master WHERE type='table' AND
-                     tbl_name='objects'; ''')
-        res = c.fetchall()
+        if c.execute('PRAGMA page_count').fetchall()[0][0] == 0:
+            # Only takes effect on an empty database, see vacuum()
+            c.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        if self.concurrency == 'wal':
+            # WAL journal mode is persistent: it is recorded in the database
+            # file and applies to every connection opened afterwards
+            c.execute('PRAGMA journal_mode=WAL').fetchall()
+
+        _migrate(conn, 'wok', SCHEMA_MIGRATIONS, self.location)
+        for obj_type, field in c.execute('SELECT type, field FROM '
+                                         'object_index_fields'):
+            self._indexes.setdefault(obj_type, set()).add(field)
+        for obj_type, field in c.execute('SELECT type, field FROM '
+                                         'object_search_fields'):
+            self._searches.setdefault(obj_type, set()).add(field)
+
         # Because the tasks are regarded as temporary resource, the task states
         # are purged every time the daemon startup
-        if len(res) == 0:
-            c.execute('''CREATE TABLE objects
-                      (id TEXT, type TEXT, json TEXT, version TEXT,
-                      PRIMARY KEY (id, type))''')
-            conn.commit()
-            return
-
-        # Clear out expired objects from a previous session
         c.execute('''DELETE FROM objects WHERE type = 'task'; ''')
+        c.execute('''DELETE FROM object_index WHERE type = 'task'; ''')
+        if FTS is not None and u'task' in self._searches:
+            c.execute('''DELETE FROM object_fts WHERE rowid IN (SELECT docid
+                      FROM object_search_docs WHERE type = 'task')''')
+            c.execute('''DELETE FROM object_search_docs
+                      WHERE type = 'task'; ''')
         conn.commit()
 
-    def _get_conn(self):
-        ident = threading.currentThread().ident
+    def keep(self, obj_type, fn):
+        """Keep the objects of <obj_type> for which fn(object) is true
+        from purge_expired(), even once expired."""
+        self._keep[_unicode(obj_type)] = fn
+
+    def migrate(self, namespace, migrations):
+        """Bring the schema of <namespace> up to date.
+
+        <migrations> is a list of (version, description, function) tuples.
+        The ones newer than the last version applied to this store are run
+        in version order, each function being called with a database cursor,
+        all in a single transaction. Plugins use their own namespace and
+        call this once at startup with their whole list of migrations.
+        Return the number of migrations run.
+        """
+        with self._lock:
+            conn = self._pool.checkout()
+            try:
+                return _migrate(conn, namespace, migrations, self.location)
+            finally:
+                self._pool.checkin(conn)
+
+    def add_index(self, obj_type, *fields):
+        """Index <fields> of the objects of type <obj_type>.
+
+        Index declarations are kept in the database, and the index is kept
+        up to date by every store and delete from then on. Existing objects
+        are indexed when a field is declared for the first time.
+
+        Usage:
+            objstore.add_index('task', 'status', 'target_uri')
+            with objstore.reader() as session:
+                session.find('task', status='running')
+        """
+        obj_type = _unicode(obj_type)
+        with self as session:
+            declared = self._indexes.get(obj_type, set())
+            new = [f for f in _unique(fields) if f not in declared]
+            if not new:
+                return
+
+            c = session.conn.cursor()
+            c.executemany('''INSERT OR IGNORE INTO object_index_fields
+                          (type, field) VALUES (?,?)''',
+                          [(obj_type, field) for field in new])
+            res = c.execute('SELECT id, json, codec FROM objects WHERE '
+                            'type=?', (obj_type,))
+            objects = [(ident, _decode(codec, data))
+                       for ident, data, codec in res]
+            session.indexes = {obj_type: declared.union(new)}
+            session._update_index(c, obj_type, objects)
+            session.conn.commit()
+            self._indexes[obj_type] = session.indexes[obj_type]
+
+    def add_search(self, obj_type, *fields):
+        """Index <fields> of the objects of type <obj_type> for full-text
+        search.
+
+        Like add_index(), declarations are kept in the database and existing
+        objects are indexed when a field is declared for the first time.
+        Text and numbers are indexed, alone or in lists.
+
+        Usage:
+            objstore.add_search('template', 'name', 'description')
+            with objstore.reader() as session:
+                session.search('template', 'fedora serv', limit=10)
+        """
+        obj_type = _unicode(obj_type)
+        with self as session:
+            declared = self._searches.get(obj_type, set())
+            new = [f for f in _unique(fields) if f not in declared]
+            if not new:
+                return
+
+            c = session.conn.cursor()
+            if FTS is not None:
+                # DDL first: it commits the transaction in progress
+                c.execute('CREATE VIRTUAL TABLE IF NOT EXISTS object_fts '
+                          'USING %s' % dict(FTS_MODULES)[FTS])
+            c.executemany('''INSERT OR IGNORE INTO object_search_fields
+                          (type, field) VALUES (?,?)''',
+                          [(obj_type, field) for field in new])
+            session.searches = {obj_type: declared.union(new)}
+            session._update_search(c, obj_type, session.iter_objects(obj_type))
+            session.conn.commit()
+            self._searches[obj_type] = session.searches[obj_type]
+
+    def _needs_codec_migration(self):
+        with self.reader() as session:
+            res = session.conn.execute("SELECT 1 FROM objects WHERE "
+                                       "IFNULL(codec, 'json') != ? LIMIT 1",
+                                       (self.codec,))
+            return len(res.fetchall()) > 0
+
+    def _codec_migration_helper(self):
         try:
-            return self._connections[ident]
-        except KeyError:
-            self._connections[ident] = sqlite3.connect(self.location,
-                                                       timeout=10)
-            if len(self._connections.keys()) > 10:
-                id, conn = self._connections.popitem(last=False)
-                conn.interrupt()
-                del conn
-            return self._connections[ident]
+            start = time.time()
+            count = self.migrate_codec(pause=CODEC_MIGRATION_PAUSE,
+                                       stop=self._closing)
+            wok_log.info("Objectstore %s: %d objects converted to %s in "
+                         "%.1fs" % (self.location, count, self.codec,
+                                    time.time() - start))
+        except Exception:
+            wok_log.error("Objectstore %s: unable to convert objects to %s" %
+                          (self.location, self.codec))
+            wok_log.error(traceback.format_exc())
 
-    def __enter__(self):
-        self._lock.acquire()
-        return ObjectStoreSession(self._get_conn())
+    def migrate_codec(self, batch_size=CODEC_MIGRATION_BATCH_SIZE, pause=0,
+                      stop=None):
+        """Re-encode the objects stored with another codec than the one of
+        this store, and return how many were converted.
 
-    def __exit__(self, type, value, tb):
-        self._lock.release()
-        if type is not None and issubclass(type, sqlite3.DatabaseError):
-                # Logs the error and return False, which makes __exit__ raise
-                # exception again
+        Objects are converted in batches of <batch_size>, each one in its
+        own writer session, sleeping <pause> seconds between them so that
+        regular writers are never held back for long. The conversion ends
+        early once <stop>, an Event, is set. Stores created with
+        <codec_migration> set run it in the background if needed, until it
+        is done or the store is closed.
+        """
+        count = 0
+        last = 0
+        while True:
+            with self as session:
+                c = session.conn.cursor()
+                # The group commit writer does not take the store lock, so
+                # keep it from committing between the read and the update
+                c.execute('BEGIN IMMEDIATE')
+                res = c.execute('SELECT rowid, json, codec FROM objects '
+                                'WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                                (last, batch_size))
+                rows = res.fetchall()
+                if not rows:
+                    return count
+
+                last = rows[-1][0]
+                rows = [(_encode(self.codec, _decode(codec, data)), rowid)
+                        for rowid, data, codec in rows
+                        if (codec or 'json') != self.codec]
+                c.executemany('UPDATE objects SET json=?, codec=? '
+                              'WHERE rowid=?',
+                              [encoded + (rowid,) for encoded, rowid in rows])
+                session.conn.commit()
+                count += len(rows)
+
+            if stop is None:
+                time.sleep(pause)
+            elif stop.wait(pause):
+                return count
+
+    def backup(self, path, batch_size=BACKUP_BATCH_SIZE, pause=0):
+        """Copy the database to <path> while the store is in use.
+
+        Rows are copied <batch_size> at a time without taking the store
+        lock, sleeping <pause> seconds between batches. In 'wal' mode all
+        of them are read from a single snapshot, which does not block
+        writers, so the copy is consistent. In 'exclusive' mode each batch
+        is read on its own, to not block writers for the whole copy: objects
+        stored meanwhile may or may not be copied.
+
+        The copy is written next to <path> and renamed once complete.
+        """
+        self.flush()
+        start = time.time()
+        tmp = path + '.tmp'
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+        snapshot = self.concurrency == 'wal'
+        conn = self._pool.checkout()
+        # Statements run in autocommit mode, unless in the snapshot
+        isolation_level = conn.isolation_level
+        conn.isolation_level = None
+        c = conn.cursor()
+        try:
+            c.execute('ATTACH DATABASE ? AS backup', (tmp,))
+            try:
+                c.execute('PRAGMA backup.auto_vacuum=INCREMENTAL')
+                if snapshot:
+                    c.execute('BEGIN')
+                try:
+                    self._backup_tables(c, batch_size, pause)
+                except:
+                    if snapshot:
+                        c.execute('ROLLBACK')
+                    raise
+                if snapshot:
+                    c.execute('COMMIT')
+            finally:
+                c.execute('DETACH DATABASE backup')
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        finally:
+            conn.isolation_level = isolation_level
+            self._pool.checkin(conn)
+
+        os.rename(tmp, path)
+        wok_log.info("Objectstore %s: backed up to %s in %.1fs" %
+                     (self.location, path, time.time() - start))
+
+    def _backup_tables(self, c, batch_size, pause):
+        res = c.execute("SELECT type, name, sql FROM main.sqlite_master "
+                        "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+                        "ORDER BY type='index'")
+        schema = res.fetchall()
+        # The tables holding the data of a virtual table, like the full-text
+        # search index, are created with it and filled through it
+        virtual = [name for _, name, sql in schema
+                   if re.match(r'CREATE\s+VIRTUAL\s', sql, re.I)]
+        schema = [x for x in schema
+                  if not any(x[1].startswith(v + '_') for v in virtual)]
+        for obj_type, name, sql in schema:
+            # CREATE TABLE objects (...) -> CREATE TABLE backup.objects (...)
+            c.execute(re.sub(r'^(CREATE\s+(UNIQUE\s+|VIRTUAL\s+)?'
+                             r'(TABLE|INDEX)\s+'
+                             r'(IF\s+NOT\s+EXISTS\s+)?)', r'\1backup.', sql,
+                             flags=re.I))
+
+        for obj_type, name, sql in schema:
+            if obj_type != 'table':
+                continue
+            if name in virtual:
+                # Keep rowids, which virtual tables leave out of SELECT *
+                columns = ', '.join(['rowid'] + _columns(c, name))
+                copy = ('INSERT INTO backup.%s (%s) SELECT %s FROM main.%s' %
+                        (name, columns, columns, name))
+            else:
+                copy = ('INSERT OR REPLACE INTO backup.%s SELECT * FROM '
+                        'main.%s' % (name, name))
+            last = 0
+            while True:
+                rowids = c.execute('SELECT rowid FROM main.%s WHERE rowid>? '
+                                   'ORDER BY rowid LIMIT ?' % name,
+                                   (last, batch_size)).fetchall()
+                if not rowids:
+                    break
+                c.execute(copy + ' WHERE rowid BETWEEN ? AND ?',
+                          (rowids[0][0], rowids[-1][0]))
+                last = rowids[-1][0]
+                time.sleep(pause)
+
+    def maintenance(self):
+        """Purge expired objects, reclaim free space and update the query
+        planner statistics, then log the size of the store.
+
+        Run every maintenance_interval seconds in the background, until the
+        store is closed.
+        """
+        if self._closing.is_set():
+            # Closed before the background task started, see close()
+            return
+        try:
+            purged = self.purge_expired()
+            self.vacuum()
+            self.analyze()
+            stats = self.stats()
+        except Exception:
+            # BackgroundTask stops for good on exceptions
+            wok_log.error("Objectstore %s: maintenance failed" %
+                          self.location)
+            wok_log.error(traceback.format_exc())
+            return
+
+        wok_log.info("Objectstore %s: %d bytes, %d free, %d in WAL. Objects: "
+                     "%s. Purged: %s" %
+                     (self.location, stats['size'], stats['free'],
+                      stats['wal_size'],
+                      ', '.join('%s=%d' % x
+                                for x in sorted(stats['objects'].items())),
+                      ', '.join('%s=%d' % x for x in sorted(purged.items()))))
+
+    def purge_expired(self, ttls=None):
+        """Delete the objects not stored again for longer than the time to
+        live of their type.
+
+        <ttls> maps object types to their time to live in seconds, the
+        'ttl' option of the objectstore config section by default. Objects
+        kept by the function given to keep() for their type, like tasks in
+        progress, are not deleted. Return a dict with the number of objects
+        deleted of each type.
+        """
+        if ttls is None:
+            ttls = self.ttls
+
+        purged = {}
+        for obj_type, ttl in ttls.iteritems():
+            with self as session:
+                c = session.conn.cursor()
+                res = c.execute('SELECT id, json, codec FROM objects WHERE '
+                                'type=? AND updated<?',
+                                (obj_type, time.time() - ttl))
+                keep = self._keep.get(_unicode(obj_type))
+                idents = [ident for ident, data, codec in res
+                          if keep is None or not keep(_decode(codec, data))]
+                session.delete_many(obj_type, idents, ignore_missing=True)
+            purged[obj_type] = len(idents)
+        return purged
+
+    def vacuum(self):
+        """Return the free pages of the database file to the file system.
+
+        Databases are created in incremental auto-vacuum mode, which frees
+        pages without rewriting the whole file. Databases created before are
+        switched to it with a full VACUUM the first time.
+        """
+        with self._lock:
+            conn = self._pool.checkout()
+            try:
+                c = conn.cursor()
+                mode = c.execute('PRAGMA auto_vacuum').fetchall()[0][0]
+                if mode != 2:
+                    start = time.time()
+                    c.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                    c.execute('VACUUM')
+                    wok_log.info("Objectstore %s: switched to incremental "
+                                 "vacuum in %.1fs" %
+                                 (self.location, time.time() - start))
+                else:
+                    c.execute('PRAGMA incremental_vacuum').fetchall()
+            finally:
+                self._pool.checkin(conn)
+
+    def analyze(self):
+        """Update the statistics used by SQLite to choose indexes."""
+        with self as session:
+            session.conn.execute('ANALYZE')
+
+    def stats(self):
+        """Return the size in bytes of the database ('size'), of its free
+        pages ('free') and of its WAL file ('wal_size'), and the number of
+        objects of each type ('objects').
+        """
+        with self.reader() as session:
+            c = session.conn.cursor()
+            page_size = c.execute('PRAGMA page_size').fetchall()[0][0]
+            pages = c.execute('PRAGMA page_count').fetchall()[0][0]
+            free = c.execute('PRAGMA freelist_count').fetchall()[0][0]
+            res = c.execute('SELECT type, COUNT(*) FROM objects GROUP BY type')
+            objects = dict(res.fetchall())
+
+        wal = self.location + '-wal'
+        return {'size': pages * page_size, 'free': free * page_size,
+                'wal_size': os.path.getsize(wal) if os.path.exists(wal) else 0,
+                'objects': objects}
+
+    @contextmanager
+    def _session(self, readonly=False, committer=False, optimistic=False):
+        # Read-only sessions in 'wal' mode run without the store lock. So
+        # does the group commit writer, as sessions holding the lock wait
+        # for it to commit their objects, and optimistic sessions
+        locked = (not (committer or optimistic) and
+                  (not readonly or self.concurrency == 'exclusive'))
+        writer = None if committer else self._writer
+        changes = []
+        if locked:
+            self._lock.acquire()
+        try:
+            conn = (self._writer.connect() if committer else
+                    self._pool.checkout())
+            broken = False
+            session = ObjectStoreSession(conn, readonly, self._indexes,
+                                         self.cache, self.codec, writer,
+                                         optimistic, self._searches)
+            changes = session.changes
+            try:
+                yield session
+            except sqlite3.DatabaseError:
+                broken = True
                 wok_log.error(traceback.format_exc())
-                return False
+                raise
+            finally:
+                if not committer:
+                    self._pool.checkin(conn, broken)
+        finally:
+            if locked:
+                self._lock.release()
+            # Notify subscribers outside the lock: they may open sessions
+            self._notify(changes)
+
+    def optimistic(self):
+        """Open a session without taking the store lock.
+
+        Writers in optimistic sessions only wait for each other while SQLite
+        commits their transactions, which in 'wal' mode does not block
+        readers either. Use store() with <expected_rev> in them: an object
+        changed by another writer since it was read raises ConflictError
+        instead of being overwritten. In group commit mode their stores are
+        committed right away.
+
+        Usage:
+            with objstore.optimistic() as session:
+                obj, rev = session.get_with_rev('vm', id)
+                obj['name'] = name
+                session.store('vm', id, obj, expected_rev=rev)
+        """
+        return self._session(optimistic=True)
+
+    def reader(self):
+        """Open a read-only session.
+
+        In 'wal' mode read-only sessions do not take the store lock, so they
+        run in parallel with each other and with the current writer, reading
+        the last committed state of the database. In 'exclusive' mode they
+        are serialized like any other session.
+
+        Usage:
+            with objstore.reader() as session:
+                session.get('task', id)
+        """
+        return self._session(readonly=True)
+
+
+def open_objectstore(location=None, engine=None):
+    """Return an object store using <engine>, the 'engine' option of the
+    objectstore config section by default. SQLite stores are split into
+    the shards set in the config, if any.
+    """
+    if engine is None:
+        engine = configParser.get('objectstore', 'engine')
+    if engine not in ENGINES:
+        raise InvalidParameter("WOKOBJST0008E",
+                               {'engine': engine,
+                                'engines': ', '.join(sorted(ENGINES))})
+    shards = [t.strip() for t in
+              configParser.get('objectstore', 'shards').split(',')]
+    shards = [t for t in shards if t]
+    if engine != 'sqlite':
+        return import_class(ENGINES[engine])(location)
+
+    # The store of the daemon converts the objects of another codec and
+    # runs maintenance, until the daemon stops
+    kargs = {'codec_migration': True,
+             'maintenance_interval': configParser.getint(
+                 'objectstore', 'maintenance_interval')}
+    if shards:
+        store = import_class('wok.shardedstore.ShardedStore')(
+            location, shards, **kargs)
+    else:
+        store = ObjectStore(location, **kargs)
+    cherrypy.engine.subscribe('stop', store.close)
+    return store
@@ -0,0 +1,244 @@
+#
+# Project Wok
+#
+# Copyright IBM Corp, 2016
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import sys
+
+from contextlib import contextmanager
+
+from wok import config
+from wok.objectstore import BaseSession, BaseStore, FLUSH_TIMEOUT
+from wok.objectstore import ObjectStore, QUERY_BATCH_SIZE, _unicode
+from wok.utils import wok_log
+
+
+class ShardedSession(BaseSession):
+    """Session on a ShardedStore.
+
+    Sessions on the shards are opened the first time an object type they
+    hold is used, and closed with this session. Shards are locked in the
+    order of ShardedStore: when a shard comes before some already locked,
+    the sessions on those are closed, and opened again once it is locked.
+    Objects read from them before may then have changed, and generators
+    returned by iter_objects() on them must not be used anymore.
+    """
+    def __init__(self, store, readonly=False, optimistic=False):
+        super(ShardedSession, self).__init__(readonly)
+        self.sharded = store
+        self.optimistic = optimistic
+        # [(shard, context manager, session)] in opening order
+        self._sessions = []
+
+    def _session(self, obj_type):
+        return self._open(self.sharded._shard(obj_type))
+
+    def _open(self, shard):
+        for opened, _, session in self._sessions:
+            if opened is shard:
+                return session
+
+        # The sessions are kept in the order of the shards, so the ones to
+        # close are the last ones
+        position = self.sharded._order.index(shard)
+        later = [opened for opened, _, _ in self._sessions
+                 if self.sharded._order.index(opened) > position]
+        for _ in later:
+            _, ctx, _ = self._sessions.pop()
+            ctx.__exit__(None, None, None)
+
+        session = self._enter(shard)
+        for opened in later:
+            self._enter(opened)
+        return session
+
+    def _enter(self, shard):
+        ctx = shard._session(self.readonly, optimistic=self.optimistic)
+        session = ctx.__enter__()
+        self._sessions.append((shard, ctx, session))
+        return session
+
+    def _close(self, type, value, tb):
+        while self._sessions:
+            _, ctx, _ = self._sessions.pop()
+            ctx.__exit__(type, value, tb)
+
+    def get_types(self):
+        types = set()
+        for shard in self.sharded._order:
+            types.update(self._open(shard).get_types())
+        return sorted(types)
+
+    def get_list(self, obj_type, sort_key=None, limit=None, offset=None,
+                 after=None):
+        return self._session(obj_type).get_list(obj_type, sort_key, limit,
+                                                offset, after)
+
+    def iter_objects(self, obj_type, batch_size=QUERY_BATCH_SIZE):
+        return self._session(obj_type).iter_objects(obj_type, batch_size)
+
+    def get(self, obj_type, ident):
+        return self._session(obj_type).get(obj_type, ident)
+
+    def get_with_rev(self, obj_type, ident):
+        return self._session(obj_type).get_with_rev(obj_type, ident)
+
+    def get_many(self, obj_type, idents, ignore_missing=False):
+        return self._session(obj_type).get_many(obj_type, idents,
+                                                ignore_missing)
+
+    def find(self, obj_type, **criteria):
+        return self._session(obj_type).find(obj_type, **criteria)
+
+    def query(self, obj_type, prefixes=None, limit=None, offset=None,
+              reverse=False, **criteria):
+        return self._session(obj_type).query(obj_type, prefixes, limit,
+                                             offset, reverse, **criteria)
+
+    def search(self, obj_type, query, limit=None):
+        return self._session(obj_type).search(obj_type, query, limit)
+
+    def get_object_version(self, obj_type, ident):
+        return self._session(obj_type).get_object_version(obj_type, ident)
+
+    def delete(self, obj_type, ident, ignore_missing=False):
+        self._session(obj_type).delete(obj_type, ident, ignore_missing)
+
+    def delete_many(self, obj_type, idents, ignore_missing=False):
+        self._session(obj_type).delete_many(obj_type, idents, ignore_missing)
+
+    def store(self, obj_type, ident, data, version=None, expected_rev=None):
+        self._session(obj_type).store(obj_type, ident, data, version,
+                                      expected_rev)
+
+    def store_many(self, obj_type, objects, version=None):
+        self._session(obj_type).store_many(obj_type, objects, version)
+
+
+class ShardedStore(BaseStore):
+    """Object store spread over several SQLite databases.
+
+    Objects of the types in <shards> are kept in a database of their own,
+    next to the one in <location> which holds every other type. Each
+    database has its own lock and connection pool, so sessions working on
+    different shards do not wait for each other.
+
+    Sessions lock the shards of the object types they use, the first time
+    they use them. So that sessions using several shards never wait for
+    each other forever, shards are always locked in the order of their
+    paths (see ShardedSession).
+
+    Objects of a type stored in the main database before the type got a
+    shard are moved to it when the store is opened.
+    """
+    def __init__(self, location=None, shards=(), **kargs):
+        super(ShardedStore, self).__init__()
+        self.location = location or config.get_object_store()
+        self.shards = {None: ObjectStore(self.location, **kargs)}
+        for obj_type in shards:
+            path = '%s.%s' % (self.location, obj_type)
+            self.shards[_unicode(obj_type)] = ObjectStore(path, **kargs)
+        self._order = sorted(self.shards.values(),
+                             key=lambda shard: shard.location)
+        for obj_type in shards:
+            self._move(_unicode(obj_type))
+
+    def _move(self, obj_type):
+        main, shard = self.shards[None], self.shards[obj_type]
+        count = 0
+        while True:
+            # Objects are only deleted from the main database once stored
+            # in the shard, so an interrupted move goes on on next start
+            with main as source:
+                idents = source.get_list(obj_type, limit=QUERY_BATCH_SIZE)
+                if not idents:
+                    break
+                objects = source.get_many(obj_type, idents)
+                with shard as target:
+                    for ident in idents:
+                        version = source.get_object_version(obj_type, ident)
+                        target.store(obj_type, ident, objects[ident],
+                                     version[0])
+                source.delete_many(obj_type, idents)
+            count += len(idents)
+
+        if count:
+            wok_log.info("Objectstore %s: %d objects of type %s moved to "
+                         "%s" % (self.location, count, obj_type,
+                                 shard.location))
+
+    def _shard(self, obj_type):
+        return self.shards.get(_unicode(obj_type), self.shards[None])
+
+    @contextmanager
+    def _session(self, readonly=False, optimistic=False):
+        session = ShardedSession(self, readonly, optimistic)
+        try:
+            yield session
+        except:
+            session._close(*sys.exc_info())
+            raise
+        else:
+            session._close(None, None, None)
+
+    def optimistic(self):
+        return self._session(optimistic=True)
+
+    def subscribe(self, obj_type, fn, ident=None):
+        shard = self._shard(obj_type)
+        return shard, shard.subscribe(obj_type, fn, ident)
+
+    def unsubscribe(self, token):
+        shard, token = token
+        shard.unsubscribe(token)
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        for shard in self.shards.values():
+            shard.flush(timeout)
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+
+    def add_index(self, obj_type, *fields):
+        self._shard(obj_type).add_index(obj_type, *fields)
+
+    def add_search(self, obj_type, *fields):
+        self._shard(obj_type).add_search(obj_type, *fields)
+
+    def keep(self, obj_type, fn):
+        self._shard(obj_type).keep(obj_type, fn)
+
+    def migrate(self, namespace, migrations):
+        return sum(shard.migrate(namespace, migrations)
+                   for shard in self.shards.values())
+
+    def backup(self, path, **kargs):
+        """Back up each shard next to <path>, as they are stored next to
+        the main database."""
+        for obj_type, shard in self.shards.iteritems():
+            shard.backup(path if obj_type is None else
+                         '%s.%s' % (path, obj_type), **kargs)
+
+    def stats(self):
+        stats = {'size': 0, 'free': 0, 'wal_size': 0, 'objects': {}}
+        for shard in self.shards.values():
+            shard_stats = shard.stats()
+            for key in ('size', 'free', 'wal_size'):
+                stats[key] += shard_stats[key]
+            stats['objects'].update(shard_stats['objects'])
+        return stats
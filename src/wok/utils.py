@@ -59,9 +59,11 @@ def get_task_id():
     return task_id
 
 
-def add_task(target_uri, fn, objstore, opaque=None):
+def add_task(target_uri, fn, objstore, opaque=None, priority='normal',
+             timeout=None, mode='thread'):
     id = get_next_task_id()
-    AsyncTask(id, target_uri, fn, objstore, opaque)
+    AsyncTask(id, target_uri, fn, objstore, opaque, priority=priority,
+              timeout=timeout, mode=mode)
     return id
 
 
@@ -629,37 +631,76 @@ def get_objectstore_fields(objstore=None):
         wok_log.error("No objectstore set up.")
         return None
     conn = sqlite3.connect(objstore, timeout=10)
-    cursor = conn.cursor()
-    schema_fields = []
-    sql = "PRAGMA table_info('objects')"
-    cursor.execute(sql)
-    for row in cursor.fetchall():
-        schema_fields.append(row[1])
-    return schema_fields
+    try:
+        cursor = conn.cursor()
+        sql = "PRAGMA table_info('objects')"
+        cursor.execute(sql)
+        return [row[1] for row in cursor.fetchall()]
+    finally:
+        conn.close()
 
 
 def upgrade_objectstore_schema(objstore=None, field=None):
     """
         Add a new column (of type TEXT) in the objectstore schema.
+        <field> may also be a list of columns, which are all added in a
+        single transaction.
     """
     if (field or objstore) is None:
         wok_log.error("Cannot upgrade objectstore schema.")
         return False
 
-    if field in get_objectstore_fields(objstore):
-        # field already exists in objectstore schema. Nothing to do.
-        return False
+    from wok.objectstore import add_columns
+    fields = field if isinstance(field, list) else [field]
     try:
-        conn = sqlite3.connect(objstore, timeout=10)
-        cursor = conn.cursor()
-        sql = "ALTER TABLE objects ADD COLUMN %s TEXT" % field
-        cursor.execute(sql)
-        wok_log.info("Objectstore schema sucessfully upgraded: %s" % objstore)
-        conn.close()
+        added = add_columns(objstore, fields)
     except sqlite3.Error, e:
-        if conn:
-            conn.rollback()
-            conn.close()
         wok_log.error("Cannot upgrade objectstore schema: %s" % e.args[0])
         return False
+    if not added:
+        # fields already exist in objectstore schema. Nothing to do.
+        return False
+    wok_log.info("Objectstore schema sucessfully upgraded: %s" % objstore)
     return True
+
+
+def search_terms(query):
+    """
+        Return the words of the search <query>, in lower case.
+    """
+    if isinstance(query, str):
+        query = query.decode('utf-8')
+    return [t.lower() for t in re.findall(r'[^\W_]+', query, re.U)]
+
+
+def search_text(obj, fields=None):
+    """
+        Return the words of the <fields> of <obj>, or of all its fields, to
+        be matched against search terms. Only text and numbers, alone or in
+        lists, are taken into account.
+    """
+    if not isinstance(obj, dict):
+        return []
+    if fields is None:
+        fields = obj.keys()
+
+    words = []
+    for field in fields:
+        value = obj.get(field)
+        for v in value if isinstance(value, list) else [value]:
+            if isinstance(v, bool) or not isinstance(v, (basestring, int,
+                                                         long, float)):
+                continue
+            words += search_terms(v if isinstance(v, basestring) else
+                                  unicode(v))
+    return words
+
+
+def search_match(obj, query, fields=None):
+    """
+        Whether every word of the search <query> starts a word of the
+        <fields> of <obj> (see search_text()).
+    """
+    words = search_text(obj, fields)
+    return all(any(w.startswith(t) for w in words)
+               for t in search_terms(query))
@@ -0,0 +1,234 @@
+#
+# Project Wok
+#
+# Copyright IBM Corp, 2016
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""Object store micro benchmarks.
+
+This is not part of the test suite. Run it from the tests directory:
+
+    PYTHONPATH=../src python bench_objectstore.py
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+from wok.objectstore import CODECS, ENGINES, ObjectStore, open_objectstore
+
+
+DURATION = 2
+NUM_OBJECTS = 500
+NUM_THREADS = [1, 2, 4, 8, 16, 32]
+
+
+def _new_store(**kargs):
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    return path, ObjectStore(path, **kargs)
+
+
+def _remove_store(path):
+    for p in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(p):
+            os.unlink(p)
+
+
+def _populate(store):
+    with store as session:
+        for i in xrange(NUM_OBJECTS):
+            session.store('task', str(i), {'id': str(i),
+                                           'status': 'running',
+                                           'message': 'OK',
+                                           'target_uri': '/tasks/%d' % i})
+
+
+def bench_readers(concurrency, num_threads):
+    """Measure read sessions per second with <num_threads> reader threads
+    (as CherryPy worker threads serving GET /tasks/<id>) while one writer
+    keeps updating task status."""
+    path, store = _new_store(concurrency=concurrency)
+    _populate(store)
+
+    stop = threading.Event()
+    counts = [0] * num_threads
+
+    def reader(n):
+        i = 0
+        while not stop.is_set():
+            with store.reader() as session:
+                session.get('task', str(i % NUM_OBJECTS))
+            i += 1
+        counts[n] = i
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            with store as session:
+                session.store('task', str(i % NUM_OBJECTS),
+                              {'id': str(i % NUM_OBJECTS),
+                               'status': 'running',
+                               'message': 'progress %d' % i,
+                               'target_uri': '/tasks/%d' % i})
+            i += 1
+
+    threads = [threading.Thread(target=reader, args=(n,))
+               for n in xrange(num_threads)]
+    threads.append(threading.Thread(target=writer))
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+
+    time.sleep(DURATION)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    _remove_store(path)
+    return sum(counts) / float(DURATION)
+
+
+def bench_cache(cache_size, num_gets=20000):
+    """Measure get() calls per second on a few hot task objects."""
+    path, store = _new_store(cache_size=cache_size)
+    _populate(store)
+
+    start = time.time()
+    with store.reader() as session:
+        for i in xrange(num_gets):
+            session.get('task', str(i % 10))
+    elapsed = time.time() - start
+
+    _remove_store(path)
+    return num_gets / elapsed
+
+
+def bench_codec(codec, num_ops=2000):
+    """Measure store() and get() calls per second on a large object, as
+    the ones kept by plugins."""
+    path, store = _new_store(codec=codec)
+    obj = {'name': u'guest', 'disks': [{'path': u'/var/lib/disk%d.img' % i,
+                                        'size': i * 1024, 'format': u'qcow2'}
+                                       for i in xrange(50)]}
+
+    with store as session:
+        start = time.time()
+        for i in xrange(num_ops):
+            session.store('vm', str(i % 10), obj)
+        stores = num_ops / (time.time() - start)
+
+        start = time.time()
+        for i in xrange(num_ops):
+            session.get('vm', str(i % 10))
+        gets = num_ops / (time.time() - start)
+
+    _remove_store(path)
+    return stores, gets
+
+
+def bench_group_commit(group_commit, num_tasks=20, num_updates=100):
+    """Measure task status updates per second from <num_tasks> threads, as
+    sent by AsyncTask._status_cb."""
+    path, store = _new_store(group_commit=group_commit)
+
+    def update(ident):
+        for i in xrange(num_updates):
+            with store as session:
+                session.store('task', ident, {'id': ident, 'status': 'running',
+                                              'message': 'step %d' % i})
+        store.flush()
+
+    threads = [threading.Thread(target=update, args=(str(i),))
+               for i in xrange(num_tasks)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    _remove_store(path)
+    return num_tasks * num_updates / elapsed
+
+
+def bench_engine(engine, num_ops=2000):
+    """Measure store(), get() and get_list() calls per second of task
+    objects, each in its own session as done by AsyncTask and TaskModel."""
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    os.unlink(path)
+    store = open_objectstore(path, engine)
+
+    start = time.time()
+    for i in xrange(num_ops):
+        with store as session:
+            session.store('vm', str(i % NUM_OBJECTS),
+                          {'id': str(i), 'status': 'running',
+                           'message': 'step %d' % i})
+    stores = num_ops / (time.time() - start)
+
+    start = time.time()
+    for i in xrange(num_ops):
+        with store.reader() as session:
+            session.get('vm', str(i % NUM_OBJECTS))
+    gets = num_ops / (time.time() - start)
+
+    start = time.time()
+    for i in xrange(num_ops / 10):
+        with store.reader() as session:
+            session.get_list('vm')
+    lists = num_ops / 10 / (time.time() - start)
+
+    _remove_store(path)
+    return stores, gets, lists
+
+
+def main():
+    print "Read sessions/s with one concurrent writer (%ds per run)" % DURATION
+    print "%-8s %12s %12s" % ('threads', 'exclusive', 'wal')
+    for num_threads in NUM_THREADS:
+        results = [bench_readers(mode, num_threads)
+                   for mode in ('exclusive', 'wal')]
+        print "%-8d %12.0f %12.0f" % tuple([num_threads] + results)
+
+    print
+    print "Hot object get()/s"
+    print "%-8s %12s" % ('no cache', 'cache')
+    print "%-8.0f %12.0f" % (bench_cache(0), bench_cache(100))
+
+    print
+    print "Large object store()/s and get()/s by codec"
+    print "%-8s %12s %12s" % ('codec', 'store', 'get')
+    for codec in sorted(CODECS):
+        print "%-8s %12.0f %12.0f" % ((codec,) + bench_codec(codec))
+
+    print
+    print "Task status updates/s from concurrent tasks"
+    print "%-8s %12s" % ('direct', 'group')
+    print "%-8.0f %12.0f" % (bench_group_commit(False),
+                             bench_group_commit(True))
+
+    print
+    print "store()/s, get()/s and get_list()/s by engine"
+    print "%-8s %12s %12s %12s" % ('engine', 'store', 'get', 'list')
+    for engine in sorted(ENGINES):
+        print "%-8s %12.0f %12.0f %12.0f" % ((engine,) + bench_engine(engine))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,488 @@
+#
+# Project Wok
+#
+# Copyright IBM Corp, 2016
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from wok import asynctask
+from wok.asynctask import AsyncTask, get_task, TaskExecutor, task_plugin
+from wok.exception import InvalidOperation, InvalidParameter
+from wok.exception import OperationFailed, TimeoutExpired
+from wok.exception import UnauthorizedError
+from wok.model.tasks import release_slot, TaskModel, TasksModel
+from wok.model.tasks import wait_slot, WaitingStream
+from wok.objectstore import ObjectStore
+
+
+tmpfile = None
+
+
+def setUpModule():
+    global tmpfile
+    tmpfile = tempfile.mktemp()
+
+
+def tearDownModule():
+    if os.path.exists(tmpfile):
+        os.unlink(tmpfile)
+
+
+def _process_task(cb, opaque):
+    # Task function run in a pool process
+    cb('started')
+    if opaque is None:
+        raise ValueError('no input')
+    cb('%d:%d' % (os.getpid(), sum(xrange(opaque))), True)
+
+
+def _dying_task(cb, opaque):
+    # Task function killing its pool process
+    cb('started')
+    os._exit(1)
+
+
+class AsyncTaskTests(unittest.TestCase):
+    def setUp(self):
+        self.objstore = ObjectStore(tmpfile)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def _blocking(self, cb, opaque):
+        self.release.wait(10)
+        cb('done', True)
+
+    def _status(self, id):
+        with self.objstore.reader() as session:
+            return session.get('task', str(id))['status']
+
+    def _message(self, id):
+        with self.objstore.reader() as session:
+            return session.get('task', str(id))['message']
+
+    def _wait_status(self, id, status, timeout=5):
+        end = time.time() + timeout
+        while self._status(id) != status and time.time() < end:
+            time.sleep(0.01)
+        self.assertEquals(status, self._status(id))
+
+    def _wait_idle(self, executor, timeout=5):
+        # Tasks are done before their worker is free
+        end = time.time() + timeout
+        while executor.stats()['running'] and time.time() < end:
+            time.sleep(0.01)
+        self.assertEquals({}, executor.stats()['running'])
+
+    def test_task_plugin(self):
+        self.assertEquals('kimchi', task_plugin('/plugins/kimchi/vms/a'))
+        self.assertEquals('wok', task_plugin('/config'))
+        self.assertEquals('wok', task_plugin(None))
+
+    def test_executor(self):
+        executor = TaskExecutor(2)
+        for i in xrange(5):
+            AsyncTask(i, '/tasks', self._blocking, self.objstore,
+                      executor=executor)
+
+        # Only two tasks run, the others wait for them
+        for i in xrange(2):
+            self._wait_status(i, 'running')
+        for i in xrange(2, 5):
+            self.assertEquals('queued', self._status(i))
+        self.assertEquals({'workers': 2, 'queued': 3,
+                           'running': {'wok': 2}}, executor.stats())
+
+        self.release.set()
+        for i in xrange(5):
+            self._wait_status(i, 'finished')
+        self.assertEquals(2, executor.stats()['workers'])
+
+    def test_executor_plugin_limits(self):
+        executor = TaskExecutor(3, plugin_limits={'kimchi': 1})
+        uri = '/plugins/kimchi/vms/a/clone'
+        AsyncTask('k1', uri, self._blocking, self.objstore, executor=executor)
+        AsyncTask('k2', uri, self._blocking, self.objstore, executor=executor)
+        AsyncTask('w1', '/config', self._blocking, self.objstore,
+                  executor=executor)
+
+        # The second kimchi task does not hold back the next ones
+        self._wait_status('k1', 'running')
+        self._wait_status('w1', 'running')
+        self.assertEquals('queued', self._status('k2'))
+
+        self.release.set()
+        for id in ('k1', 'k2', 'w1'):
+            self._wait_status(id, 'finished')
+
+    def test_executor_queue_size(self):
+        executor = TaskExecutor(1, queue_size=1)
+        AsyncTask('q1', '/tasks', self._blocking, self.objstore,
+                  executor=executor)
+        self._wait_status('q1', 'running')
+        AsyncTask('q2', '/tasks', self._blocking, self.objstore,
+                  executor=executor)
+        self.assertRaises(OperationFailed, AsyncTask, 'q3', '/tasks',
+                          self._blocking, self.objstore, executor=executor)
+        self.assertEquals('failed', self._status('q3'))
+
+    def test_executor_priorities(self):
+        executor = TaskExecutor(1)
+        AsyncTask('p0', '/tasks', self._blocking, self.objstore,
+                  executor=executor)
+        self._wait_status('p0', 'running')
+
+        started = []
+
+        def fn(cb, id):
+            started.append(id)
+            cb('done', True)
+
+        for id, priority in (('p1', 'bulk'), ('p2', 'normal'),
+                             ('p3', 'interactive'), ('p4', 'bulk'),
+                             ('p5', 'interactive')):
+            AsyncTask(id, '/tasks', fn, self.objstore, id,
+                      executor=executor, priority=priority)
+        self.release.set()
+        for id in ('p1', 'p2', 'p3', 'p4', 'p5'):
+            self._wait_status(id, 'finished')
+        self.assertEquals(['p3', 'p5', 'p2', 'p1', 'p4'], started)
+
+        self.assertRaises(InvalidParameter, AsyncTask, 'p6', '/tasks', fn,
+                          self.objstore, executor=executor, priority='high')
+
+    def test_executor_fair_share(self):
+        executor = TaskExecutor(2)
+        kimchi = '/plugins/kimchi/vms/a/clone'
+        AsyncTask('k1', kimchi, self._blocking, self.objstore,
+                  executor=executor)
+        hold = threading.Event()
+        self.addCleanup(hold.set)
+        AsyncTask('k2', kimchi, lambda cb, opaque: hold.wait(10),
+                  self.objstore, executor=executor)
+        self._wait_status('k1', 'running')
+        self._wait_status('k2', 'running')
+
+        started = []
+
+        def fn(cb, id):
+            started.append(id)
+            cb('done', True)
+
+        # Once k1 is done, a plugin with no running task goes ahead of one
+        # with a running task, though its task was queued last
+        for id, uri in (('k3', kimchi), ('k4', kimchi),
+                        ('g1', '/plugins/ginger/users')):
+            AsyncTask(id, uri, fn, self.objstore, id, executor=executor)
+        self.release.set()
+        for id in ('k3', 'k4', 'g1'):
+            self._wait_status(id, 'finished')
+        self.assertEquals('g1', started[0])
+
+    def test_progress(self):
+        saved = []
+        self.objstore.subscribe('task', lambda *args: saved.append(args),
+                                'pr1')
+        progress = threading.Event()
+
+        def fn(cb, opaque):
+            for i in xrange(100):
+                cb('%d%%' % i)
+            progress.set()
+            self._blocking(cb, opaque)
+
+        task = AsyncTask('pr1', '/tasks', fn, self.objstore,
+                         executor=TaskExecutor(1))
+        self.assertTrue(progress.wait(5))
+        # Progress is saved at most once a second
+        self.assertEquals(2, len(saved))
+        self.assertEquals('OK', self._message('pr1'))
+
+        # but lookup() returns the current one
+        model = TaskModel(objstore=self.objstore)
+        self.assertEquals({'id': 'pr1', 'target_uri': '/tasks',
+                           'status': 'running', 'message': '99%'},
+                          model.lookup('pr1'))
+        self.assertTrue(get_task('pr1') is task)
+
+        # The background thread saves the last progress
+        asynctask._save_progress()
+        self.assertEquals('99%', self._message('pr1'))
+        asynctask._save_progress()
+        self.assertEquals(3, len(saved))
+
+        # States are saved right away
+        self.release.set()
+        self._wait_status('pr1', 'finished')
+        self.assertEquals('done', self._message('pr1'))
+        self.assertEquals(None, get_task('pr1'))
+
+    def test_wait(self):
+        model = TaskModel(objstore=self.objstore)
+        AsyncTask('w1', '/tasks', self._blocking, self.objstore,
+                  executor=TaskExecutor(1))
+        start = time.time()
+        self.assertRaises(TimeoutExpired, model.wait, 'w1', 0.2)
+        self.assertTrue(0.2 <= time.time() - start < 1)
+
+        # Waiters wake up as soon as the task is done
+        threading.Timer(0.1, self.release.set).start()
+        start = time.time()
+        model.wait('w1', 5)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEquals('finished', self._status('w1'))
+
+        # Tasks of other processes are read from the object store
+        with self.objstore as session:
+            session.store('task', 'w2', {'id': 'w2', 'target_uri': '/tasks',
+                                         'message': 'OK',
+                                         'status': 'running'})
+
+        def finish():
+            with self.objstore as session:
+                task = session.get('task', 'w2')
+                task['status'] = 'finished'
+                session.store('task', 'w2', task)
+
+        threading.Timer(0.1, finish).start()
+        start = time.time()
+        model.wait('w2', 5)
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_cancel(self):
+        executor = TaskExecutor(1)
+        model = TaskModel(objstore=self.objstore)
+        checked = threading.Event()
+
+        def fn(cb, opaque):
+            # Cooperative task: stops at its next check once cancelled
+            while not cb.token.wait(10):
+                pass
+            checked.set()
+            cb.check()
+            cb('done', True)
+
+        AsyncTask('x1', '/tasks', fn, self.objstore, executor=executor)
+        AsyncTask('x2', '/tasks', self._blocking, self.objstore,
+                  executor=executor)
+        AsyncTask('x3', '/tasks', self._blocking, self.objstore,
+                  executor=executor)
+        self._wait_status('x1', 'running')
+
+        # Users only cancel their own tasks
+        self.assertRaises(UnauthorizedError, model.delete, 'x2', 'nobody')
+        self.assertEquals('queued', self._status('x2'))
+
+        # Queued tasks leave the queue
+        model.delete('x2')
+        self.assertEquals('cancelled', self._status('x2'))
+        self.assertEquals(1, executor.stats()['queued'])
+
+        model.delete('x1')
+        self.assertTrue(checked.wait(5))
+        self.assertEquals('cancelled', self._status('x1'))
+        self._wait_status('x3', 'running')
+        self.assertRaises(InvalidOperation, model.delete, 'x1')
+
+        # Tasks of other processes cannot be cancelled by this one
+        with self.objstore as session:
+            session.store('task', 'x4', {'id': 'x4', 'target_uri': '/tasks',
+                                         'message': 'OK',
+                                         'status': 'running'})
+        self.assertRaises(InvalidOperation, model.delete, 'x4')
+
+    def test_cancel_stuck(self):
+        executor = TaskExecutor(1)
+        AsyncTask('s1', '/tasks', self._blocking, self.objstore,
+                  executor=executor, timeout=0.2)
+        AsyncTask('s2', '/tasks', lambda cb, opaque: cb('done', True),
+                  self.objstore, executor=executor)
+
+        # Past its deadline, the task is cancelled and its worker slot
+        # is given to the next task, though it does not stop
+        self._wait_status('s1', 'cancelled')
+        self.assertTrue('0.2 seconds' in self._message('s1'))
+        self._wait_status('s2', 'finished')
+        self._wait_idle(executor)
+        self.assertEquals(1, executor.stats()['workers'])
+
+        # What it reports once it ends is ignored
+        self.release.set()
+        time.sleep(0.1)
+        self.assertEquals('cancelled', self._status('s1'))
+
+    def test_process_mode(self):
+        executor = TaskExecutor(2)
+        AsyncTask('m1', '/tasks', _process_task, self.objstore, 1000,
+                  executor=executor, mode='process')
+        AsyncTask('m2', '/tasks', _process_task, self.objstore,
+                  executor=executor, mode='process')
+        TaskModel(objstore=self.objstore).wait('m1', 10)
+        TaskModel(objstore=self.objstore).wait('m2', 10)
+
+        # Status messages are relayed from the pool process
+        pid, result = self._message('m1').split(':')
+        self.assertNotEquals(os.getpid(), int(pid))
+        self.assertEquals(str(sum(xrange(1000))), result)
+        self.assertEquals('failed', self._status('m2'))
+        self.assertTrue('no input' in self._message('m2'))
+        self._wait_idle(executor)
+
+        # Tasks fail if their process dies, and free their worker
+        executor = TaskExecutor(1)
+        AsyncTask('m5', '/tasks', _dying_task, self.objstore,
+                  executor=executor, mode='process')
+        AsyncTask('m6', '/tasks', _process_task, self.objstore, 10,
+                  executor=executor, mode='process')
+        TaskModel(objstore=self.objstore).wait('m5', 10)
+        self.assertEquals('failed', self._status('m5'))
+        self.assertTrue('exited unexpectedly' in self._message('m5'))
+        TaskModel(objstore=self.objstore).wait('m6', 10)
+        self.assertEquals('finished', self._status('m6'))
+
+        self.assertRaises(InvalidParameter, AsyncTask, 'm3', '/tasks',
+                          lambda cb, opaque: None, self.objstore,
+                          executor=executor, mode='process')
+        self.assertRaises(InvalidParameter, AsyncTask, 'm4', '/tasks',
+                          _process_task, self.objstore, executor=executor,
+                          mode='fork')
+
+    def test_query(self):
+        model = TasksModel(objstore=self.objstore)
+        with self.objstore as session:
+            for i in xrange(8, 12):
+                uri = '/plugins/%s/vms/%d' % ('kimchi' if i % 2 else 'ginger',
+                                              i)
+                session.store('task', str(i), {'id': str(i), 'message': 'OK',
+                                               'target_uri': uri,
+                                               'status': 'finished'})
+
+        def fn(cb, opaque):
+            cb('50%')
+            self._blocking(cb, opaque)
+
+        AsyncTask('12', '/plugins/kimchi/vms/12', fn, self.objstore,
+                  executor=TaskExecutor(1))
+        end = time.time() + 5
+        while get_task('12').info()['message'] != '50%' and \
+                time.time() < end:
+            time.sleep(0.01)
+
+        # Newest first, with the current progress of the tasks running here
+        tasks = model.query()
+        self.assertEquals(['12', '11', '10', '9', '8'],
+                          [t['id'] for t in tasks])
+        self.assertEquals('50%', tasks[0]['message'])
+        self.assertEquals(['11', '9'],
+                          [t['id'] for t in model.query('finished',
+                                                        '/plugins/kimchi')])
+        self.assertEquals(['10', '9'],
+                          [t['id'] for t in model.query(limit=2, offset=2)])
+        self.assertEquals([], model.query('failed'))
+
+        # Full-text search, as GET /tasks?_search= does
+        self.assertEquals(['10', '8'], sorted(model.search('ginger')))
+        self.assertEquals(['11', '9'], sorted(model.search('kim finished')))
+
+    def test_wait_change(self):
+        model = TaskModel(objstore=self.objstore)
+        progress = threading.Event()
+
+        def fn(cb, opaque):
+            progress.wait(10)
+            cb('50%')
+            self._blocking(cb, opaque)
+
+        AsyncTask('c1', '/tasks', fn, self.objstore, executor=TaskExecutor(1))
+        self._wait_status('c1', 'running')
+        info = model.lookup('c1')
+        self.assertEquals(info, model.wait_change('c1', info, 0.1))
+
+        threading.Timer(0.1, progress.set).start()
+        start = time.time()
+        info = model.wait_change('c1', info, 5)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEquals('50%', info['message'])
+
+        self.release.set()
+        info = model.wait_change('c1', info, 5)
+        self.assertEquals('finished', info['status'])
+        # Done tasks do not change anymore
+        self.assertEquals(info, model.wait_change('c1', info, 5))
+
+    def test_watch(self):
+        events = TasksModel(objstore=self.objstore).watch(timeout=5,
+                                                          keepalive=0.1)
+        self.assertEquals(None, next(events))
+
+        AsyncTask('e1', '/tasks', self._blocking, self.objstore,
+                  executor=TaskExecutor(1))
+        self.release.set()
+        statuses = []
+        for task in events:
+            if task is not None and task['id'] == 'e1':
+                statuses.append(task['status'])
+                if task['status'] == 'finished':
+                    break
+        events.close()
+        self.assertEquals('finished', statuses[-1])
+
+        # Tasks of other users are left out
+        events = TasksModel(objstore=self.objstore).watch('nobody',
+                                                          timeout=0.3,
+                                                          keepalive=0.1)
+        self.assertEquals(None, next(events))
+        AsyncTask('e2', '/tasks', self._blocking, self.objstore,
+                  executor=TaskExecutor(1))
+        self.assertEquals(set([None]), set(events))
+
+    def _free_slots(self):
+        count = 0
+        try:
+            while True:
+                wait_slot()
+                count += 1
+        except OperationFailed:
+            pass
+        for i in xrange(count):
+            release_slot()
+        return count
+
+    def test_waiting_stream(self):
+        free = self._free_slots()
+        self.assertTrue(free > 0)
+
+        # The slot is released once the stream ends, or is closed, even
+        # before it started
+        model = TasksModel(objstore=self.objstore)
+        for consume in (list, lambda stream: next(stream), lambda stream: 0):
+            wait_slot()
+            stream = WaitingStream(model.watch(timeout=0.2, keepalive=0.1))
+            self.assertEquals(free - 1, self._free_slots())
+            consume(stream)
+            stream.close()
+            stream.close()
+            self.assertEquals(free, self._free_slots())
+
+        for i in xrange(free):
+            wait_slot()
+        self.assertRaises(OperationFailed, wait_slot)
+        for i in xrange(free):
+            release_slot()
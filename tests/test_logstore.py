@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# Project Wok
+#
+# Copyright IBM Corp, 2016
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os
+import tempfile
+import unittest
+
+from StringIO import StringIO
+
+from wok import logstore
+from wok.config import get_version
+from wok.exception import ConflictError, InvalidParameter, NotFoundError
+from wok.exception import OperationFailed
+from wok.objectstore import open_objectstore
+
+
+class LogStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mktemp()
+
+    def tearDown(self):
+        for path in (self.path + '.log', self.path + '.log.compact'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def test_logstore(self):
+        store = open_objectstore(self.path, engine='log')
+        self.assertTrue(isinstance(store, logstore.LogStore))
+        self.assertEquals(self.path + '.log', store.location)
+
+        with store as session:
+            session.store('fǒǒ', 'těst1', {'α': 1})
+            session.store('fǒǒ', 'těst2', {'b': 2})
+            session.store('fǒǒ', 'těst1', {'α': 3})
+            session.store('task', '1', {'status': 'running'})
+
+            self.assertEquals([u'těst1', u'těst2'], session.get_list('fǒǒ'))
+            self.assertEquals({u'α': 3}, session.get('fǒǒ', 'těst1'))
+            self.assertEquals([get_version().split('-')[0]],
+                              session.get_object_version('fǒǒ', 'těst1'))
+            self.assertEquals([u'těst2'],
+                              session.get_list('fǒǒ', after='těst1'))
+            self.assertEquals([u'těst2'], session.find('fǒǒ', b=2))
+
+            session.delete('fǒǒ', 'těst2')
+            self.assertRaises(NotFoundError, session.get, 'fǒǒ', 'těst2')
+            self.assertRaises(NotFoundError, session.delete, 'fǒǒ', 'těst2')
+            self.assertRaises(NotFoundError, session.delete_many, 'fǒǒ',
+                              ['těst1', 'těst2'])
+            self.assertEquals({u'těst1': {u'α': 3}},
+                              session.get_many('fǒǒ', ['těst1']))
+            self.assertRaises(InvalidParameter, session.get_list, 'fǒǒ',
+                              sort_key='α', after='těst1')
+
+        with store.reader() as session:
+            self.assertRaises(OperationFailed, session.store, 'fǒǒ', 'x', {})
+
+        with store.optimistic() as session:
+            obj, rev = session.get_with_rev('fǒǒ', 'těst1')
+            self.assertEquals(2, rev)
+            session.store('fǒǒ', 'těst1', {'α': 4}, expected_rev=rev)
+            self.assertRaises(ConflictError, session.store, 'fǒǒ', 'těst1',
+                              {'α': 5}, expected_rev=rev)
+            self.assertRaises(ConflictError, session.store, 'fǒǒ', 'těst2',
+                              {}, expected_rev=1)
+
+        # The log is read back on startup, tasks are purged
+        store = logstore.LogStore(self.path)
+        with store as session:
+            self.assertEquals(({u'α': 4}, 3),
+                              session.get_with_rev('fǒǒ', 'těst1'))
+            self.assertEquals([], session.get_list('fǒǒ', after='těst1'))
+            self.assertEquals([], session.get_list('task'))
+
+    def test_logstore_backup(self):
+        backup = self.path + '.bak'
+        self.addCleanup(os.unlink, backup + '.log')
+
+        store = logstore.LogStore(self.path)
+        with store as session:
+            session.store_many('vm', [(str(i), {'i': i}) for i in xrange(5)])
+            session.delete('vm', '4')
+        store.backup(backup)
+
+        data = StringIO()
+        self.assertEquals(4, store.export_objects(data, batch_size=3))
+        data.seek(0)
+        self.assertEquals(data.getvalue(),
+                          self._export(logstore.LogStore(backup)))
+
+        # Objects can be moved between engines
+        path = self.path + '.sqlite'
+        self.addCleanup(os.unlink, path)
+        sqlite = open_objectstore(path, engine='sqlite')
+        sqlite.import_objects(data)
+        self.assertEquals(data.getvalue(), self._export(sqlite))
+
+    def _export(self, store):
+        data = StringIO()
+        store.export_objects(data)
+        return data.getvalue()
+
+    def test_logstore_recovery(self):
+        store = logstore.LogStore(self.path)
+        with store as session:
+            session.store('vm', 'a', {'x': 1})
+            session.store('vm', 'b', {'x': 2})
+
+        # Writes interrupted by a crash, even once the record is complete
+        for partial in ('["s", "vm", "c", "2.0", {"x"',
+                        '["s", "vm", "c", "2.0", {"x": 4}, 1]'):
+            with open(self.path + '.log', 'ab') as f:
+                f.write(partial)
+
+            store = logstore.LogStore(self.path)
+            with store as session:
+                self.assertEquals([u'a', u'b'], session.get_list('vm'))
+            with store as session:
+                session.store('vm', 'c', {'x': 3})
+            with logstore.LogStore(self.path) as session:
+                self.assertEquals({u'x': 3}, session.get('vm', 'c'))
+                session.delete('vm', 'c')
+
+        # Corrupted records elsewhere are not dropped
+        with open(self.path + '.log', 'rb') as f:
+            data = f.read()
+        with open(self.path + '.log', 'wb') as f:
+            f.write('["s", "vm", "a", "2.0"\n' + data)
+        self.assertRaises(OperationFailed, logstore.LogStore, self.path)
+        with open(self.path + '.log', 'rb') as f:
+            self.assertEquals('["s", "vm", "a", "2.0"\n' + data, f.read())
+
+    def test_logstore_compaction(self):
+        self.addCleanup(setattr, logstore, 'COMPACT_MIN_GARBAGE',
+                        logstore.COMPACT_MIN_GARBAGE)
+        logstore.COMPACT_MIN_GARBAGE = 1024
+
+        store = logstore.LogStore(self.path)
+        with store as session:
+            session.store('vm', 'keep', {'x': 0})
+        for i in xrange(100):
+            with store as session:
+                session.store('vm', 'a', {'x': i})
+
+        # Each session that leaves more garbage than live data compacts
+        stats = store.stats()
+        self.assertTrue(stats['size'] <= 2 * 1024)
+        self.assertEquals(os.path.getsize(self.path + '.log'),
+                          stats['size'])
+        self.assertEquals({u'vm': 2}, stats['objects'])
+
+        store.compact()
+        self.assertEquals(0, store.stats()['free'])
+        with logstore.LogStore(self.path) as session:
+            self.assertEquals({u'x': 99}, session.get('vm', 'a'))
+            self.assertEquals({u'x': 0}, session.get('vm', 'keep'))
@@ -21,13 +21,20 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
 import os
+import sqlite3
 import tempfile
 import threading
+import time
 import unittest
 
+from StringIO import StringIO
+
 from wok import objectstore
 from wok.config import get_version
-from wok.exception import NotFoundError
+from wok.exception import ConflictError, InvalidParameter, NotFoundError
+from wok.exception import OperationFailed
+from wok.shardedstore import ShardedStore
+from wok.utils import get_objectstore_fields, upgrade_objectstore_schema
 
 
 tmpfile = None
@@ -39,10 +46,16 @@ def setUpModule():
 
 
 def tearDownModule():
-    os.unlink(tmpfile)
+    for path in (tmpfile, tmpfile + '-wal', tmpfile + '-shm'):
+        if os.path.exists(path):
+            os.unlink(path)
 
 
 class ObjectStoreTests(unittest.TestCase):
+    def _unlink(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+
     def test_objectstore(self):
         store = objectstore.ObjectStore(tmpfile)
 
@@ -82,6 +95,699 @@ class ObjectStoreTests(unittest.TestCase):
             item = session.get_object_version('fǒǒ', 'těst1')
             self.assertEquals(get_version().split('-')[0], item[0])
 
+    def test_objectstore_batch(self):
+        store = objectstore.ObjectStore(tmpfile)
+
+        with store as session:
+            objs = dict((u'těst%d' % i, {'α': i}) for i in xrange(1200))
+            session.store_many('bǎtch', objs)
+            self.assertEquals(1200, len(session.get_list('bǎtch')))
+
+            # Existing objects are replaced
+            session.store_many('bǎtch', [('těst1', {'α': -1})])
+            self.assertEquals(1200, len(session.get_list('bǎtch')))
+
+            items = session.get_many('bǎtch', ['těst1', 'těst2', 'těst1'])
+            self.assertEquals({u'těst1': {u'α': -1}, u'těst2': {u'α': 2}},
+                              items)
+            idents = objs.keys()[:700]
+            items = session.get_many('bǎtch', idents)
+            self.assertEquals(sorted(idents), sorted(items.keys()))
+
+            # Missing objects
+            self.assertRaises(NotFoundError, session.get_many, 'bǎtch',
+                              ['těst1', 'foo'])
+            items = session.get_many('bǎtch', ['těst1', 'foo'],
+                                     ignore_missing=True)
+            self.assertEquals([u'těst1'], items.keys())
+
+            # Deleting a missing object deletes nothing
+            self.assertRaises(NotFoundError, session.delete_many, 'bǎtch',
+                              ['těst1', 'foo'])
+            self.assertEquals(1200, len(session.get_list('bǎtch')))
+
+            session.delete_many('bǎtch', ['těst1', 'foo'],
+                                ignore_missing=True)
+            self.assertEquals(1199, len(session.get_list('bǎtch')))
+
+            session.delete_many('bǎtch', session.get_list('bǎtch'))
+            self.assertEquals([], session.get_list('bǎtch'))
+
+    def test_objectstore_sorted_list(self):
+        store = objectstore.ObjectStore(tmpfile)
+
+        with store as session:
+            for i in xrange(10):
+                session.store('sǒrt', 'těst%d' % i, {'k': 9 - i, 's': str(i)})
+
+            expected = [u'těst%d' % i for i in reversed(xrange(10))]
+            self.assertEquals(expected, session.get_list('sǒrt', 'k'))
+            self.assertEquals(expected[2:5],
+                              session.get_list('sǒrt', 'k', limit=3,
+                                               offset=2))
+            self.assertEquals(expected[8:],
+                              session.get_list('sǒrt', 'k', offset=8))
+            self.assertEquals(sorted(expected)[:4],
+                              session.get_list('sǒrt', limit=4))
+
+            # Same results without the JSON1 extension
+            objectstore.HAS_JSON1 = False
+            try:
+                self.assertEquals(expected, session.get_list('sǒrt', 'k'))
+                self.assertEquals(expected[2:5],
+                                  session.get_list('sǒrt', 'k', limit=3,
+                                                   offset=2))
+            finally:
+                objectstore.HAS_JSON1 = objectstore._has_json1()
+
+    def test_objectstore_pages(self):
+        store = objectstore.ObjectStore(tmpfile)
+        idents = ['%03d' % i for i in xrange(25)]
+        with store as session:
+            session.store_many('pǎge', [(i, {'i': i}) for i in idents])
+
+            pages = []
+            page = session.get_list('pǎge', limit=10, after='')
+            while page:
+                pages.append(page)
+                page = session.get_list('pǎge', limit=10, after=page[-1])
+            self.assertEquals([idents[:10], idents[10:20], idents[20:]],
+                              pages)
+            self.assertEquals(idents[21:], session.get_list('pǎge',
+                                                            after='020'))
+            self.assertRaises(InvalidParameter, session.get_list, 'pǎge',
+                              sort_key='i', after='020')
+
+            objects = list(session.iter_objects('pǎge', batch_size=5))
+            self.assertEquals([(i, {u'i': i}) for i in idents], objects)
+            self.assertEquals([], list(session.iter_objects('nǒne')))
+
+    def test_objectstore_migrations(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.unlink, path)
+
+        # Databases from before schema versions were recorded
+        conn = sqlite3.connect(path)
+        conn.execute('''CREATE TABLE objects (id TEXT, type TEXT, json TEXT,
+                     version TEXT, PRIMARY KEY (id, type))''')
+        conn.execute('''INSERT INTO objects VALUES ('old', 'vm', '{"a": 1}',
+                     '2.0')''')
+        conn.commit()
+        conn.close()
+
+        store = objectstore.ObjectStore(path)
+        with store as session:
+            self.assertEquals({u'a': 1}, session.get('vm', 'old'))
+            c = session.conn.cursor()
+            res = c.execute('SELECT * FROM schema_version')
+            self.assertEquals([('wok', len(objectstore.SCHEMA_MIGRATIONS))],
+                              res.fetchall())
+
+        applied = []
+
+        def step(version):
+            return (version, 'step %d' % version,
+                    lambda c: applied.append(version))
+
+        self.assertEquals(2, store.migrate('plugin', [step(2), step(1)]))
+        self.assertEquals(1, store.migrate('plugin',
+                                           [step(1), step(2), step(3)]))
+        self.assertEquals(0, store.migrate('plugin', [step(1)]))
+        self.assertEquals([1, 2, 3], applied)
+
+        # Failed migrations are rolled back as a whole
+        def fail(c):
+            raise sqlite3.OperationalError('fail')
+        self.assertRaises(sqlite3.OperationalError, store.migrate, 'plugin',
+                          [(4, 'add table', lambda c: c.execute(
+                              'CREATE TABLE plugin (a)')), (5, 'fail', fail)])
+        self.assertEquals(1, store.migrate('plugin', [step(4)]))
+
+        self.assertTrue(upgrade_objectstore_schema(path, ['a', 'b']))
+        self.assertFalse(upgrade_objectstore_schema(path, 'a'))
+        self.assertEquals(['a', 'b'], get_objectstore_fields(path)[-2:])
+
+    def test_objectstore_maintenance(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.unlink, path)
+
+        store = objectstore.ObjectStore(path)
+        store.keep('task', lambda task: task['status'] == 'running')
+        with store as session:
+            session.store_many('task', [('1', {'status': 'finished'}),
+                                        ('2', {'status': 'running'}),
+                                        ('3', {'status': 'failed'})])
+            session.store('vm', 'a', {'x': 'y' * 100000})
+            # Make all objects older than a minute but task 3
+            c = session.conn.cursor()
+            c.execute("UPDATE objects SET updated=updated-120 WHERE id!='3'")
+            session.conn.commit()
+
+        # Running tasks are kept
+        self.assertEquals({'task': 1}, store.purge_expired({'task': 60}))
+        self.assertEquals({'vm': 0}, store.purge_expired({'vm': 600}))
+        self.assertEquals({u'task': 2, u'vm': 1}, store.stats()['objects'])
+
+        with store as session:
+            session.delete('vm', 'a')
+        self.assertTrue(store.stats()['free'] > 0)
+        store.vacuum()
+        store.analyze()
+        stats = store.stats()
+        self.assertEquals(0, stats['free'])
+        self.assertEquals({u'task': 2}, stats['objects'])
+
+        store.maintenance()
+
+        # Maintenance only runs in the background if asked to, until the
+        # store is closed
+        self.assertEquals(None, store.maintenance_task)
+        store = objectstore.ObjectStore(path, maintenance_interval=3600)
+        end = time.time() + 5
+        while not store.maintenance_task.running and time.time() < end:
+            time.sleep(0.01)
+        self.assertTrue(store.maintenance_task.running)
+        store.close()
+        self.assertFalse(store.maintenance_task.running)
+
+    def test_objectstore_revisions(self):
+        store = objectstore.ObjectStore(tmpfile, cache_size=10)
+        with store.optimistic() as session:
+            session.store('rěv', 'a', {'n': 0}, expected_rev=0)
+            self.assertRaises(ConflictError, session.store, 'rěv', 'a',
+                              {'n': 0}, expected_rev=0)
+            session.store('rěv', 'a', {'n': 1})
+            obj, rev = session.get_with_rev('rěv', 'a')
+            self.assertEquals(({u'n': 1}, 2), (obj, rev))
+
+            session.store('rěv', 'a', {'n': 2}, expected_rev=rev)
+            # Lost update: the object changed since it was read
+            self.assertRaises(ConflictError, session.store, 'rěv', 'a',
+                              {'n': 3}, expected_rev=rev)
+            self.assertRaises(ConflictError, session.store, 'rěv', 'b',
+                              {'n': 3}, expected_rev=1)
+            self.assertEquals(({u'n': 2}, 3),
+                              session.get_with_rev('rěv', 'a'))
+            self.assertEquals({u'n': 2}, session.get('rěv', 'a'))
+
+        def worker(ident):
+            # Increment the counter of <ident>, retrying on conflicts
+            for i in xrange(20):
+                while True:
+                    with store.optimistic() as session:
+                        obj, rev = session.get_with_rev('rěv', ident)
+                        obj['n'] += 1
+                        try:
+                            session.store('rěv', ident, obj,
+                                          expected_rev=rev)
+                            break
+                        except ConflictError:
+                            pass
+
+        threads = [threading.Thread(target=worker, args=('a',))
+                   for i in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        with store as session:
+            # No update was lost
+            self.assertEquals({u'n': 82}, session.get('rěv', 'a'))
+            self.assertEquals(({u'n': 82}, 83),
+                              session.get_with_rev('rěv', 'a'))
+
+    def test_objectstore_backup(self):
+        for mode in objectstore.CONCURRENCY_MODES:
+            path = tempfile.mktemp()
+            backup = tempfile.mktemp()
+            for p in (path, path + '-wal', path + '-shm', backup):
+                self.addCleanup(self._unlink, p)
+
+            store = objectstore.ObjectStore(path, concurrency=mode)
+            store.add_index('vm', 'state')
+            store.add_search('vm', 'name')
+            with store as session:
+                session.store_many('vm', [(str(i), {'state': i % 2,
+                                                    'name': 'vm%d' % i})
+                                          for i in xrange(25)])
+            store.backup(backup, batch_size=10)
+
+            copy = objectstore.ObjectStore(backup)
+            with copy as session:
+                self.assertEquals(sorted(str(i) for i in xrange(25)),
+                                  sorted(session.get_list('vm')))
+                self.assertEquals({u'state': 1, u'name': u'vm7'},
+                                  session.get('vm', '7'))
+                self.assertEquals(12, len(session.find('vm', state=1)))
+                self.assertEquals([u'7'], session.search('vm', 'vm7'))
+
+    def test_objectstore_export(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.unlink, path)
+
+        store = objectstore.ObjectStore(tmpfile)
+        with store as session:
+            objects = [('%02d' % i, {'ǐ': i}) for i in xrange(25)]
+            session.store_many('ěxport', objects)
+            session.store('ěxport2', 'a', {'b': [1, 2]})
+
+        data = StringIO()
+        count = store.export_objects(data, ['ěxport', 'ěxport2'],
+                                     batch_size=10)
+        self.assertEquals(26, count)
+        data.seek(0)
+
+        copy = objectstore.ObjectStore(path)
+        self.assertEquals(26, copy.import_objects(data, batch_size=10))
+        with copy as session:
+            self.assertEquals([u'ěxport', u'ěxport2'], session.get_types())
+            self.assertEquals(['%02d' % i for i in xrange(25)],
+                              session.get_list('ěxport', limit=25))
+            self.assertEquals({u'ǐ': 3}, session.get('ěxport', '03'))
+            self.assertEquals({u'b': [1, 2]}, session.get('ěxport2', 'a'))
+
+    def test_objectstore_sharded(self):
+        path = tempfile.mktemp()
+        for p in (path, path + '.task'):
+            self.addCleanup(self._unlink, p)
+
+        store = ShardedStore(path, ['task'])
+        store.add_index('task', 'status')
+        with store as session:
+            session.store('task', '1', {'status': 'running'})
+            session.store('vm', 'a', {'name': 'a'}, '1.0')
+            self.assertEquals(['1'], session.find('task', status='running'))
+            self.assertEquals([u'task', u'vm'], session.get_types())
+
+        for p, obj_type in ((path, 'vm'), (path + '.task', 'task')):
+            conn = sqlite3.connect(p)
+            res = conn.execute('SELECT DISTINCT type FROM objects')
+            self.assertEquals([(obj_type,)], res.fetchall())
+            conn.close()
+
+        # Sessions using the shards in different orders lock them in the
+        # same one, so they do not wait for each other forever
+        done = []
+
+        def worker(first, second, ident):
+            with store as session:
+                session.get_list(first)
+                time.sleep(0.1)
+                session.store(second, ident, {'name': ident})
+            done.append(ident)
+
+        # Sessions only using the task shard do not wait for the main one
+        thread = threading.Thread(target=worker, args=('vm', 'vm', 'c'))
+        thread.start()
+        time.sleep(0.05)
+        start = time.time()
+        with store as session:
+            session.store('task', '3', {'name': '3'})
+        self.assertTrue(time.time() - start < 0.05)
+        thread.join()
+
+        threads = [threading.Thread(target=worker, args=args) for args in
+                   (('task', 'vm', 'b'), ('vm', 'task', '2'))]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEquals(set(['b', 'c', '2']), set(done))
+
+        with store.watch('task', '1') as watch:
+            with store as session:
+                session.store('task', '1', {'status': 'finished'})
+            self.assertTrue(watch.wait(0))
+        self.assertEquals({u'vm': 3, u'task': 3}, store.stats()['objects'])
+
+        # Objects stored before their type got a shard are moved to it
+        self.addCleanup(self._unlink, path + '.vm')
+        store = ShardedStore(path, ['task', 'vm'])
+        with store as session:
+            self.assertEquals({'name': 'a'}, session.get('vm', 'a'))
+            self.assertEquals([u'a', u'b', u'c'],
+                              sorted(session.get_list('vm')))
+        with store.shards[None] as session:
+            self.assertEquals([], session.get_list('vm'))
+        with store.shards[u'vm'] as session:
+            self.assertEquals([u'1.0'],
+                              session.get_object_version('vm', 'a'))
+
+    def test_objectstore_index(self):
+        store = objectstore.ObjectStore(tmpfile)
+
+        with store as session:
+            session.store('ǐdx', '1', {'status': 'running', 'users': ['a']})
+            session.store('ǐdx', '2', {'status': 'running', 'size': 1})
+
+        # Existing objects are indexed on declaration
+        store.add_index('ǐdx', 'status', 'users')
+
+        with store as session:
+            session.store('ǐdx', '3',
+                          {'status': 'finished', 'users': ['a', 'b'],
+                           'size': 1})
+            session.store_many('ǐdx', [('4', {'status': 'finished'}),
+                                        ('5', {'status': u'rǔnning'})])
+
+            self.assertEquals([u'1', u'2'],
+                              sorted(session.find('ǐdx', status='running')))
+            self.assertEquals([u'1', u'3'],
+                              sorted(session.find('ǐdx', users='a')))
+            self.assertEquals([u'5'], session.find('ǐdx', status='rǔnning'))
+            self.assertEquals([u'3'], session.find('ǐdx', status='finished',
+                                                   users='b'))
+
+            # Non-indexed fields are checked against the objects
+            self.assertEquals([u'2'], session.find('ǐdx', status='running',
+                                                   size=1))
+            self.assertEquals([u'2', u'3'],
+                              sorted(session.find('ǐdx', size=1)))
+
+            # Updates and deletes keep the index up to date
+            session.store('ǐdx', '1', {'status': 'finished'})
+            session.delete('ǐdx', '2')
+            session.delete_many('ǐdx', ['3', '4'])
+            self.assertEquals([], session.find('ǐdx', status='running'))
+            self.assertEquals([u'1'], session.find('ǐdx', status='finished'))
+            self.assertEquals([], session.find('ǐdx', users='a'))
+
+        # Declarations are persistent
+        store = objectstore.ObjectStore(tmpfile)
+        with store.reader() as session:
+            self.assertEquals(set(['status', 'users']),
+                              session.indexes[u'ǐdx'])
+            self.assertEquals([u'1'], session.find('ǐdx', status='finished'))
+
+    def test_objectstore_query(self):
+        store = objectstore.ObjectStore(tmpfile)
+        store.add_index('query', 'status', 'uri')
+
+        with store as session:
+            for i in xrange(1, 13):
+                session.store('query', str(i),
+                              {'status': 'running' if i % 3 else 'failed',
+                               'uri': '/plugins/%s/%d' %
+                               ('kimchi' if i % 2 else 'ginger', i),
+                               'size': i % 4})
+
+            def idents(*args, **kargs):
+                objects = session.query('query', *args, **kargs)
+                # Same result as the fallback of other engines
+                self.assertEquals(objects, objectstore.BaseSession.query(
+                    session, 'query', *args, **kargs))
+                return [ident for ident, obj in objects]
+
+            # Numeric idents are in numeric order
+            self.assertEquals(map(unicode, xrange(1, 13)), idents())
+            self.assertEquals([u'12', u'11', u'10'],
+                              idents(limit=3, reverse=True))
+            self.assertEquals([u'9', u'8'],
+                              idents(limit=2, offset=3, reverse=True))
+            self.assertEquals([u'3', u'6', u'9', u'12'],
+                              idents(status='failed'))
+            self.assertEquals([u'9', u'3'],
+                              idents({'uri': '/plugins/kim'}, reverse=True,
+                                     status='failed'))
+            self.assertEquals([], idents({'uri': 'kimchi'}))
+
+            # Non-indexed fields are checked against the objects
+            self.assertEquals([u'1', u'5', u'9'],
+                              idents({'uri': '/plugins/k'}, size=1))
+            self.assertEquals([u'5'], idents({'uri': '/plugins/k'}, size=1,
+                                             offset=1, limit=1))
+            self.assertEquals([u'4', u'8'], idents({'status': 'r'}, size=0))
+
+            objects = session.query('query', {'uri': '/plugins/ginger/1'},
+                                    status='running')
+            self.assertEquals([(u'10', {'status': 'running',
+                                        'uri': '/plugins/ginger/10',
+                                        'size': 2})], objects)
+
+    def test_objectstore_search(self):
+        store = objectstore.ObjectStore(tmpfile)
+
+        with store as session:
+            server = {'name': 'Fedora Server', 'tags': ['web', 'db'],
+                      'size': 20}
+            session.store('sěarch', '1', server)
+            session.store('sěarch', '2', {'name': 'Fedora Workstation'})
+
+        # Existing objects are indexed on declaration
+        store.add_search('sěarch', 'name', 'tags')
+
+        with store as session:
+            objects = [('3', {'name': 'Ubuntu Server'}),
+                       ('4', {'name': u'Débian', 'tags': ['web']})]
+            session.store_many('sěarch', objects)
+
+            self.assertEquals([u'1', u'2'],
+                              sorted(session.search('sěarch', 'fedora')))
+            # Every word must match, as a prefix of a word of the object
+            self.assertEquals([u'1'], session.search('sěarch', 'FED serv'))
+            self.assertEquals([u'1', u'4'],
+                              sorted(session.search('sěarch', 'web')))
+            self.assertEquals([u'4'], session.search('sěarch', u'débian'))
+            self.assertEquals(1, len(session.search('sěarch', 'server',
+                                                    limit=1)))
+            # Undeclared fields are not searched
+            self.assertEquals([], session.search('sěarch', '20'))
+            self.assertEquals([u'1', u'2', u'3', u'4'],
+                              session.search('sěarch', ' '))
+
+            # Updates and deletes keep the search index up to date
+            session.store('sěarch', '1', {'name': 'CentOS'})
+            session.delete('sěarch', '2')
+            session.delete_many('sěarch', ['3'])
+            self.assertEquals([], session.search('sěarch', 'fedora'))
+            self.assertEquals([], session.search('sěarch', 'server'))
+            self.assertEquals([u'1'], session.search('sěarch', 'cent'))
+
+        # Declarations are persistent
+        store = objectstore.ObjectStore(tmpfile)
+        with store as session:
+            self.assertEquals(set(['name', 'tags']),
+                              session.searches[u'sěarch'])
+            self.assertEquals([u'1'], session.search('sěarch', 'centos'))
+            # Types with no declared fields are searched on all fields
+            session.store('sěarch2', 'a', {'size': 20, 'name': 'x'})
+            self.assertEquals([u'a'], session.search('sěarch2', '20'))
+
+        fts = objectstore.FTS
+        objectstore.FTS = None
+        try:
+            with store.reader() as session:
+                self.assertEquals([u'4'], session.search('sěarch', 'WEB'))
+                self.assertEquals([u'1'], session.search('sěarch', 'cent'))
+        finally:
+            objectstore.FTS = fts
+
+    def test_objectstore_cache(self):
+        store = objectstore.ObjectStore(tmpfile, cache_size=2)
+
+        with store as session:
+            session.store('cǎche', '1', {'α': (1, 2)})
+            session.store_many('cǎche', {'2': {'α': 2}, '3': {'α': 3}})
+
+            # Objects are cached as they would be read from the database
+            self.assertEquals({u'α': [1, 2]}, session.get('cǎche', '1'))
+            self.assertEquals({'size': 2, 'capacity': 2, 'hits': 0,
+                               'misses': 1}, store.cache.stats())
+
+            # Cached objects are copied on every read
+            session.get('cǎche', '1')[u'α'].append(3)
+            self.assertEquals({u'α': [1, 2]}, session.get('cǎche', '1'))
+            self.assertEquals(2, store.cache.hits)
+
+            self.assertEquals({u'2': {u'α': 2}, u'3': {u'α': 3}},
+                              session.get_many('cǎche', ['2', '3']))
+            self.assertEquals(3, store.cache.hits)
+            self.assertEquals(2, store.cache.misses)
+
+            session.delete('cǎche', '3')
+            self.assertRaises(NotFoundError, session.get, 'cǎche', '3')
+            session.delete_many('cǎche', ['1', '2'])
+            self.assertRaises(NotFoundError, session.get, 'cǎche', '1')
+            self.assertEquals(0, store.cache.stats()['size'])
+
+        # Objects read before a write went through the cache are not cached
+        cache = objectstore.ObjectCache(10)
+        generation = cache.generation
+        cache.put('a', 1)
+        cache.fill('b', 2, generation)
+        self.assertRaises(KeyError, cache.get, 'b')
+        cache.fill('b', 2, cache.generation)
+        self.assertEquals(2, cache.get('b'))
+
+    def test_objectstore_codec(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.unlink, path)
+
+        store = objectstore.ObjectStore(path)
+        with store as session:
+            session.store('cǒdec', 'j', {'α': 'json', 'k': 2})
+
+        codecs = ['marshal']
+        if objectstore.msgpack is not None:
+            codecs.append('msgpack')
+
+        for codec in codecs:
+            store = objectstore.ObjectStore(path, codec=codec)
+            with store as session:
+                session.store('cǒdec', codec, {'α': codec, 'k': 1})
+                session.store_many('cǒdec', [(codec + '2', {'k': 3})])
+
+                # Rows of every codec are read back
+                self.assertEquals({u'α': u'json', u'k': 2},
+                                  session.get('cǒdec', 'j'))
+                self.assertEquals({u'α': codec, u'k': 1},
+                                  session.get('cǒdec', codec))
+                # Read back as JSON reads them back
+                obj = objectstore._decode(*reversed(objectstore._encode(
+                    codec, {'t': (1, 'ǒ'), 'l': [{'α': None}]})))
+                self.assertEquals({u't': [1, u'ǒ'], u'l': [{u'α': None}]},
+                                  obj)
+                self.assertEquals([list, unicode],
+                                  [type(obj[u't']), type(obj[u't'][1])])
+                self.assertEquals(['j', codec + '2'],
+                                  sorted(session.get_many('cǒdec',
+                                                          ['j', codec + '2'])))
+                self.assertEquals([codec], session.find('cǒdec', k=1))
+                self.assertEquals([codec, 'j', codec + '2'],
+                                  session.get_list('cǒdec', 'k')[-3:])
+
+                c = session.conn.cursor()
+                res = c.execute('SELECT codec FROM objects WHERE id=?',
+                                (codec,))
+                self.assertEquals([(codec,)], res.fetchall())
+                session.delete_many('cǒdec', [codec, codec + '2'])
+                session.store('cǒdec', codec, {'k': 0})
+
+        # Changing codec converts stored objects, in the background if
+        # asked to, until the store is closed
+        store = objectstore.ObjectStore(path, codec='marshal',
+                                        codec_migration=True)
+        store.close()
+        store.migrate_codec()
+        with store as session:
+            c = session.conn.cursor()
+            res = c.execute('SELECT DISTINCT codec FROM objects')
+            self.assertEquals([('marshal',)], res.fetchall())
+            self.assertEquals({u'α': u'json', u'k': 2},
+                              session.get('cǒdec', 'j'))
+
+        self.assertRaises(InvalidParameter, objectstore.ObjectStore, path,
+                          codec='foo')
+
+    def test_objectstore_group_commit(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.unlink, path)
+
+        store = objectstore.ObjectStore(path, group_commit=True)
+        with store as session:
+            for i in xrange(10):
+                session.store('grǒup', 'obj', {'i': i})
+            session.store('grǒup', 'other', {'i': 10})
+            # Queued objects are read back before they are committed
+            self.assertEquals({u'i': 9}, session.get('grǒup', 'obj'))
+            self.assertEquals({'obj': {u'i': 9}, 'other': {u'i': 10}},
+                              session.get_many('grǒup', ['obj', 'other']))
+            # Queries commit them first
+            self.assertEquals(['obj', 'other'],
+                              sorted(session.get_list('grǒup')))
+
+        with store as session:
+            session.store('grǒup', 'last', {'i': 11})
+        store.flush()
+
+        # Everything is on disk once flushed, coalesced into one row each
+        reader = objectstore.ObjectStore(path)
+        with reader as session:
+            c = session.conn.cursor()
+            res = c.execute('SELECT id, json FROM objects ORDER BY id')
+            self.assertEquals([('last', '{"i": 11}'), ('obj', '{"i": 9}'),
+                               ('other', '{"i": 10}')], res.fetchall())
+
+            session.delete('grǒup', 'last')
+        with store as session:
+            self.assertRaises(NotFoundError, session.get, 'grǒup', 'last')
+
+        # The writer does not wait for a connection of the pool, which
+        # sessions waiting for it may hold
+        store = objectstore.ObjectStore(path, concurrency='wal', pool_size=2,
+                                        group_commit=True)
+        with store as session:
+            session.store('grǒup', 'new', {'i': 12})
+        readers = []
+        results = []
+
+        def read():
+            with store.reader() as session:
+                readers.append(session)
+                while len(readers) < 2:
+                    time.sleep(0.01)
+                results.append(session.get_list('grǒup'))
+
+        threads = [threading.Thread(target=read) for i in xrange(2)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEquals([['new', 'obj', 'other']] * 2,
+                          [sorted(result) for result in results])
+
+        # Closing the store commits the queued objects and stops the writer
+        with store as session:
+            session.store('grǒup', 'closed', {'i': 13})
+        writer = store._writer
+        store.close()
+        self.assertFalse(writer._thread.isAlive())
+        with reader as session:
+            self.assertEquals({u'i': 13}, session.get('grǒup', 'closed'))
+
+    def test_objectstore_notify(self):
+        store = objectstore.ObjectStore(tmpfile)
+        changes = []
+
+        def changed(obj_type, ident, event):
+            changes.append((obj_type, ident, event))
+
+        token = store.subscribe('nǒtify', changed)
+        one = store.subscribe('nǒtify', changed, ident='ǒne')
+        with store as session:
+            session.store('nǒtify', 'ǒne', {})
+            session.store_many('nǒtify', {'two': {}})
+            session.store('other', 'ǒne', {})
+            # Subscribers are called once the session is closed
+            self.assertEquals([], changes)
+        self.assertEquals([(u'nǒtify', u'ǒne', 'store'),
+                           (u'nǒtify', u'ǒne', 'store'),
+                           (u'nǒtify', u'two', 'store')], changes)
+
+        store.unsubscribe(one)
+        del changes[:]
+        with store as session:
+            session.delete_many('nǒtify', ['ǒne', 'two'])
+            session.delete('nǒtify', 'ǒne', ignore_missing=True)
+        self.assertEquals([(u'nǒtify', u'ǒne', 'delete'),
+                           (u'nǒtify', u'two', 'delete')], changes)
+        store.unsubscribe(token)
+
+        def worker():
+            with store as session:
+                session.store('nǒtify', 'ǒne', {})
+
+        # Waiters wake up on changes made from other threads
+        with store.watch('nǒtify', 'ǒne') as watch:
+            self.assertFalse(watch.wait(0.01))
+            t = threading.Timer(0.05, worker)
+            t.start()
+            self.assertTrue(watch.wait(5))
+            t.join()
+
     def test_object_store_threaded(self):
         def worker(ident):
             with store as session:
@@ -101,4 +807,81 @@ class ObjectStoreTests(unittest.TestCase):
 
         with store as session:
             self.assertEquals(50, len(session.get_list('foo')))
-            self.assertEquals(10, len(store._connections.keys()))
+
+        # Writers are serialized, so a single connection was reused by all
+        # threads
+        self.assertEquals(1, store._pool.created)
+
+    def test_object_store_pool(self):
+        store = objectstore.ObjectStore(tmpfile, concurrency='wal',
+                                        pool_size=4)
+        with store as session:
+            for i in xrange(10):
+                session.store('baz', str(i), {'i': i})
+
+        errors = []
+
+        def worker(ident):
+            try:
+                with store.reader() as session:
+                    self.assertEquals({'i': ident},
+                                      session.get('baz', str(ident % 10)))
+            except Exception as e:
+                errors.append(e)
+
+        threads = []
+        for i in xrange(50):
+            t = threading.Thread(target=worker, args=(i % 10,))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+        self.assertEquals([], errors)
+        self.assertTrue(store._pool.created <= 4)
+
+        # Checkout fails once all connections are in use
+        pool = objectstore.ConnectionPool(tmpfile, 1, timeout=0.1)
+        conn = pool.checkout()
+        self.assertRaises(OperationFailed, pool.checkout)
+        pool.checkin(conn)
+        self.assertTrue(pool.checkout() is conn)
+
+        # Broken connections are replaced
+        conn.close()
+        pool.checkin(conn, broken=True)
+        self.assertEquals(0, pool.created)
+        self.assertFalse(pool.checkout() is conn)
+
+    def test_object_store_wal_readers(self):
+        store = objectstore.ObjectStore(tmpfile, concurrency='wal')
+
+        with store as session:
+            session.store('bar', 'těst1', {'α': 1})
+
+        # A writer session in progress does not block readers
+        with store:
+            results = []
+
+            def reader():
+                with store.reader() as session:
+                    results.append(session.get('bar', 'těst1'))
+
+            t = threading.Thread(target=reader)
+            t.setDaemon(True)
+            t.start()
+            t.join(5)
+            self.assertFalse(t.isAlive())
+            self.assertEquals([{u'α': 1}], results)
+
+        with store.reader() as session:
+            self.assertEquals([u'těst1'], session.get_list('bar'))
+            self.assertRaises(OperationFailed, session.store, 'bar', 'těst2',
+                              {})
+            self.assertRaises(OperationFailed, session.delete, 'bar',
+                              'těst1')
+
+        self.assertRaises(InvalidParameter, objectstore.ObjectStore, tmpfile,
+                          concurrency='foo')
@@ -22,7 +22,7 @@
 import unittest
 
 from wok.exception import InvalidParameter
-from wok.utils import convert_data_size
+from wok.utils import convert_data_size, search_match
 
 
 class UtilsTests(unittest.TestCase):
@@ -69,3 +69,15 @@ class UtilsTests(unittest.TestCase):
 
         for d in success_data:
             self.assertEquals(d['got'], d['want'])
+
+    def test_search_match(self):
+        obj = {'name': 'Fedora_Server 24', 'tags': ['web', u'ca\u010d'],
+               'enabled': True, 'info': {'owner': 'root'}}
+        self.assertTrue(search_match(obj, 'fed SERV'))
+        self.assertTrue(search_match(obj, '24 web'))
+        self.assertTrue(search_match(obj, 'ca\xc4\x8d'))
+        self.assertTrue(search_match(obj, ''))
+        self.assertFalse(search_match(obj, 'fedora ubuntu'))
+        self.assertFalse(search_match(obj, 'true'))
+        self.assertFalse(search_match(obj, 'root'))
+        self.assertFalse(search_match(obj, 'web', fields=['name']))